@@ -6,8 +6,6 @@ Still very incomplete.'''
 import json
 import re
 
-import requests
-
 import random
 hexdigits = '0123456789abcdef'
 def newid():
@@ -42,6 +40,12 @@ class BeeminderMock:
                     pt.update(params)
                     return pt
             return None
+        if request_type == 'post' and path.endswith('create_all.json'):
+            points = json.loads(params['datapoints'])
+            for point in points:
+                point['id'] = newid()
+            self.mockdata.extend(points)
+            return points
         if request_type == 'post' and path.endswith('datapoints.json'):
             point = params
             point['id'] = newid()
@@ -60,6 +64,7 @@ class BeeminderBackend:
         self.auth_token = auth_token
         self.dryrun = dryrun
         self.debug = debug
+        self.session = None  # one keep-alive connection for all requests
 
 
     def execute(self, path, params=None, request_type='get'):
@@ -79,7 +84,10 @@ class BeeminderBackend:
             print(repr(key))
             return self.dryrun[key]
         path = path.lstrip('/')
-        method = getattr(requests, request_type)
+        if self.session is None:
+            import requests  # slow to import, so only when actually needed
+            self.session = requests.Session()
+        method = getattr(self.session, request_type)
         args = {'auth_token': self.auth_token}
         if params is not None:
             args.update(params)
@@ -195,4 +203,4 @@ class Beeminder:
         path = '/users/{}/goals/{}/datapoints/create_all.json'.format(
             self.username, slug)
         datapoints = json.dumps(points)
-        self.post(path, params={'datapoints': datapoints})
+        return self.post(path, params={'datapoints': datapoints})
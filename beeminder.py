@@ -9,13 +9,21 @@
 from settings import settings
 import util
 import beemapi
+import criteria
+import segments
+import tagquery
 
+import json
+import locale
+import marshal
 import os.path
 from pprint import pprint, pformat
 from collections import defaultdict
 import re
 import sys
 import time
+import types
+import zlib
 
 # use Data::Dumper; $Data::Dumper::Terse = 1;
 # $| = 1; # autoflush
@@ -23,322 +31,527 @@ import time
 
 def usage():
     print("Usage: ./beeminder.py tagtimelog user/slug", file=sys.stderr)
+    print("       ./beeminder.py --all [tagtimelog]  (all the goals in "
+          "beeminder in .pytagtimerc)", file=sys.stderr)
     print("beemauth must be defined in .pytagtimerc", file=sys.stderr)
     sys.exit(1)
 
 
-def main():
-    ping = hours_per_ping = settings.gap / 3600
+class Goal:
+    '''Syncing one Beeminder goal with the TagTime log.'''
 
-    if len(sys.argv) != 3 or settings.beemauth is None:
-        usage()
-    ttlf = sys.argv[1]     # tagtime log filename
-    usrslug = sys.argv[2]  # like alice/weight
-    m = re.search(r"^(?:.*?(?:\.\/)?data\/)?([^\+\/\.]*)[\+\/]([^\.]*)", usrslug)
-    if not m:
-        usage()
-    usr, slug = m.groups();
+    CREATE_CHUNK = 100  # datapoints per create_all request
+    BATCH = 50          # updates or deletes between checkpoints of the cache
 
-    beem = beemapi.Beeminder(settings.beemauth, usr)
+    def __init__(self, usr, slug, crit, beem):
+        self.usr = usr
+        self.slug = slug
+        self.crit = crit
+        self.beem = beem
+        # beef = bee file (cache of data on bmndr)
+        self.beef = os.path.join(settings.path, '{}+{}.bee'.format(usr, slug))
+        self.statef = self.beef + '.state'
 
-    # beef = bee file (cache of data on bmndr)
-    beef = os.path.join(settings.path, '{}+{}.bee'.format(usr, slug))
+    def read_cache(self):
+        '''Reads what's on Beeminder from the .bee cache file, or fetches it
+        from Beeminder if the cache is missing or broken.'''
+        beem, slug, beef = self.beem, self.slug, self.beef
 
-    #if(defined(@beeminder)) { # for backward compatibility
-    #  print "Deprecation warning: Get your settings file in line!\n";
-    #  print "Specifically, 'beeminder' should be a hash, not an arry.\n";
-    #  for(@beeminder) {
-    #    @stuff = split(/\s+/, $_); # usrslug and tags
-    #    $us = shift(@stuff);
-    #    $beeminder{$us} = [@stuff];
-    #  }
-    #}
+        # ph (ping hash) maps "y-m-d" to number of pings on that day.
+        # sh (string hash) maps "y-m-d" to the beeminder comment string for that day.
+        # bh (beeminder hash) maps "y-m-d" to the bmndr ID of the datapoint on that day.
+        # ph1 and sh1 are based on the current tagtime log and
+        # ph0 and sh0 are based on the cached .bee file or beeminder-fetched data.
+        bh = {}
+        ph1 = defaultdict(int)
+        sh1 = defaultdict(str)
+        ph0 = defaultdict(int)
+        sh0 = defaultdict(str)
+        start = time.time()   # start and end are the earliest and latest times we will
+        end   = 0             # need to care about when updating beeminder.
+        # bflag is true if we need to regenerate the beeminder cache file. reasons we'd
+        # need to: 1. it doesn't exist or is empty; 2. any beeminder IDs are missing
+        # from the cache file; 3. there are multiple datapoints for the same day.
+        try:
+            bflag = not os.stat(beef).st_size
+        except FileNotFoundError:
+            bflag = True
+        bf1 = False
+        bf2 = False
+        bf3 = False
+        bf4 = False  # why bflag?
+        if bflag:
+            bf1 = True
 
-    crit = settings.beeminder.get(usrslug)
-    if crit is None:
-        raise ValueError("Can't determine which tags match {}".format(usrslug))
-
-    # ph (ping hash) maps "y-m-d" to number of pings on that day.
-    # sh (string hash) maps "y-m-d" to the beeminder comment string for that day.
-    # bh (beeminder hash) maps "y-m-d" to the bmndr ID of the datapoint on that day.
-    # ph1 and sh1 are based on the current tagtime log and
-    # ph0 and sh0 are based on the cached .bee file or beeminder-fetched data.
-    ph = defaultdict(int)
-    sh = defaultdict(str)
-    bh = {}
-    ph1 = defaultdict(int)
-    sh1 = defaultdict(str)
-    ph0 = defaultdict(int)
-    sh0 = defaultdict(str)
-    start = time.time()   # start and end are the earliest and latest times we will
-    end   = 0             # need to care about when updating beeminder.
-    # bflag is true if we need to regenerate the beeminder cache file. reasons we'd
-    # need to: 1. it doesn't exist or is empty; 2. any beeminder IDs are missing
-    # from the cache file; 3. there are multiple datapoints for the same day.
-    try:
-        bflag = not os.stat(beef).st_size
-    except FileNotFoundError:
-        bflag = True
-    bf1 = False
-    bf2 = False
-    bf3 = False
-    bf4 = False  # why bflag?
-    if bflag:
-        bf1 = True
-
-    remember = {} # remember which dates we've already seen in the cache file
-    try:
-        with open(beef, 'r') as B:
-            for line in B:
-                m = re.search(r'''
-                (\d+)\s+		  # year
-                (\d+)\s+		  # month
-                (\d+)\s+		  # day
-                (\S+)\s+		  # value
-                "(\d+)			  # number of pings
-                (?:[^\n\"\(:]*) # currently the string " ping(s)"
-                :                 # the ": " after " pings"
-                ([^\[]*)          # the comment string (no brackets)
-                (?:\[             # if present,
-                bID\:([^\]]*)     # the beeminder ID, in brackets
-                \])?              # end bracket for "[bID:abc123]"
-                \s*"
-                              ''', line, re.VERBOSE)
-                # XXX if not m set an error flag and continue
-                y, m, d, v, p, c, b = m.groups()
-                y = int(y)
-                m = int(m)
-                d = int(d)
-                p = int(p)
-                c = c.strip()
-                ts = '{:04}-{:02}-{:02}'.format(y, m, d)
-
-                ph0[ts] = p
-                #$ph0{$ts} = $p;
-                #$c =~ s/\s+$//;
-                #m = re.match(r'\s+$/', c)
-                sh0[ts] = c
-                bh[ts] = b
-                t = time.mktime((y, m, d, 0, 0, 0, 0, 0, -1))
+        remember = {} # remember which dates we've already seen in the cache file
+        try:
+            with open(beef, 'r') as B:
+                for line in B:
+                    m = re.search(r'''
+                    (\d+)\s+		  # year
+                    (\d+)\s+		  # month
+                    (\d+)\s+		  # day
+                    (\S+)\s+		  # value
+                    "(\d+)			  # number of pings
+                    (?:[^\n\"\(:]*) # currently the string " ping(s)"
+                    :                 # the ": " after " pings"
+                    ([^\[]*)          # the comment string (no brackets)
+                    (?:\[             # if present,
+                    bID\:([^\]]*)     # the beeminder ID, in brackets
+                    \])?              # end bracket for "[bID:abc123]"
+                    \s*"
+                                  ''', line, re.VERBOSE)
+                    # XXX if not m set an error flag and continue
+                    y, m, d, v, p, c, b = m.groups()
+                    y = int(y)
+                    m = int(m)
+                    d = int(d)
+                    p = int(p)
+                    c = c.strip()
+                    ts = '{:04}-{:02}-{:02}'.format(y, m, d)
+
+                    ph0[ts] = p
+                    #$ph0{$ts} = $p;
+                    #$c =~ s/\s+$//;
+                    #m = re.match(r'\s+$/', c)
+                    sh0[ts] = c
+                    bh[ts] = b
+                    t = time.mktime((y, m, d, 0, 0, 0, 0, 0, -1))
+                    if t < start:
+                        start = t
+                    if t > end:
+                        end = t
+                    if not b:
+                        bflag = True
+                        bf2 += 1
+                        if bf2 == 1:
+                            print("Problem with this line in cache file:\n{}".format(line))
+                        elif bf2 == 2:
+                            print("Additional problems with cache file, which is expected if this "
+                                  "is your first time updating TagTime with the new Bmndr API.\n")
+                    if remember.get(ts):
+                        bflag = bf3 = True
+                    remember[ts] = True;
+        except IOError:
+            bflag = True
+            bf4 = True
+
+        if bflag: # re-slurp all the datapoints from beeminder
+            ph0 = defaultdict(int)
+            sh0 = defaultdict(str)
+            bh = {}
+            start = time.time() # reset these since who knows what happened to
+            end   = 0           # them when we calculated them from the cache file
+            # we decided to toss.
+
+            #my $tmp = $beef;  $tmp =~ s/(?:[^\/]*\/)*//; # strip path from filename
+            tmp = os.path.basename(beef)
+            if bf1:
+                print("Cache file missing or empty ({}); recreating... ".format(tmp))
+            elif bf2:
+                print("Cache file doesn't have all the Bmndr IDs; recreating... ")
+            elif bf3:
+                print("Cache file has duplicate Bmndr IDs; recreating... ")
+            elif bf4:
+                print("Couldn't read cache file; recreating... ")
+            else:   # this case is impossible
+                print("Recreating Beeminder cache ({})[{bf1}{bf2}{bf3}{bf4}]... ".format(
+                    bf1=bf1, bf2=bf2, bf3=bf3, bf4=bf4
+                ))
+
+            data = beem.data(slug)
+            print("[Bmndr data fetched]")
+
+            # take one pass to delete any duplicates on bmndr; must be one datapt per day
+            #i = 0;
+            remember = {}
+            newdata = []
+            for x in data:
+                tm = time.localtime(x["timestamp"])
+                y, m, d = tm.tm_year, tm.tm_mon, tm.tm_mday
+                timetuple = time.localtime(x['timestamp'])
+                # XXX okay so we're using localtime here, but
+                # does this change if/when generalized
+                # midnight is rolled out, etc?
+                ts = time.strftime('%Y-%m-%d', timetuple)
+                b = x['id']
+                if remember.get(ts) is not None:
+                    print("Beeminder has multiple datapoints for the same day. "
+                          "The other id is {}. Deleting this one:".format(remember[ts]))
+                    pprint(x)
+                    beem.delete_point(slug, b)
+                else:
+                    newdata.append(x)
+                remember[ts] = b
+                #i += 1
+
+            data = newdata
+            # for my $x (reverse(@todelete)) {
+            #   splice(@$data,$x,1);
+            # }
+            for x in data:   # parse the bmndr data into %ph0, %sh0, %bh
+                timetuple = time.localtime(x['timestamp'])
+                y, m, d, *rest = timetuple
+                # XXX see note above about generalized midnight
+                ts = time.strftime('%Y-%m-%d', timetuple)
+                #t = util.pd(ts)     # XXX isn't x['timestamp'] the unix time anyway already
+                t = x['timestamp']
                 if t < start:
                     start = t
                 if t > end:
                     end = t
-                if not b:
-                    bflag = True
-                    bf2 += 1
-                    if bf2 == 1:
-                        print("Problem with this line in cache file:\n{}".format(line))
-                    elif bf2 == 2:
-                        print("Additional problems with cache file, which is expected if this "
-                              "is your first time updating TagTime with the new Bmndr API.\n")
-                if remember.get(ts):
-                    bflag = bf3 = True
-                remember[ts] = True;
-    except IOError:
-        bflag = True
-        bf4 = True
+                v = x['value']
+                c = x['comment']
+                b = x['id']
+                i = re.search(r'^\d+', c)
+                ph0[ts] = int(i.group(0) if i else 0) # ping count is first thing in the comment
+                sh0[ts] = re.sub(r'[^:]*:\s+', '', c) # drop the "n pings:" comment prefix
+                # This really shouldn't happen.
+                if ts in bh:
+                    raise ValueError(
+                        "Duplicate cached/fetched id datapoints for {ts}: {bhts}, {b}.\n{val}".format(
+                            ts=ts, bhts=bh[ts], b=b, val=pformat(x)))
+                bh[ts] = b
 
-    if bflag: # re-slurp all the datapoints from beeminder
-        ph0 = defaultdict(int)
-        sh0 = defaultdict(str)
-        bh = {}
-        start = time.time() # reset these since who knows what happened to
-        end   = 0           # them when we calculated them from the cache file
-        # we decided to toss.
-
-        #my $tmp = $beef;  $tmp =~ s/(?:[^\/]*\/)*//; # strip path from filename
-        tmp = os.path.basename(beef)
-        if bf1:
-            print("Cache file missing or empty ({}); recreating... ".format(tmp))
-        elif bf2:
-            print("Cache file doesn't have all the Bmndr IDs; recreating... ")
-        elif bf3:
-            print("Cache file has duplicate Bmndr IDs; recreating... ")
-        elif bf4:
-            print("Couldn't read cache file; recreating... ")
-        else:   # this case is impossible
-            print("Recreating Beeminder cache ({})[{bf1}{bf2}{bf3}{bf4}]... ".format(
-                bf1=bf1, bf2=bf2, bf3=bf3, bf4=bf4
-            ))
-
-        data = beem.data(slug)
-        print("[Bmndr data fetched]")
-
-        # take one pass to delete any duplicates on bmndr; must be one datapt per day
-        #i = 0;
-        remember = {}
-        newdata = []
-        for x in data:
-            tm = time.localtime(x["timestamp"])
-            y, m, d = tm.tm_year, tm.tm_mon, tm.tm_mday
-            timetuple = time.localtime(x['timestamp'])
-            # XXX okay so we're using localtime here, but
-            # does this change if/when generalized
-            # midnight is rolled out, etc?
-            ts = time.strftime('%Y-%m-%d', timetuple)
-            b = x['id']
-            if remember.get(ts) is not None:
-                print("Beeminder has multiple datapoints for the same day. "
-                      "The other id is {}. Deleting this one:".format(remember[ts]))
-                pprint(x)
-                beem.delete_point(slug, b)
-            else:
-                newdata.append(x)
-            remember[ts] = b
-            #i += 1
-
-        data = newdata
-        # for my $x (reverse(@todelete)) {
-        #   splice(@$data,$x,1);
-        # }
-        for x in data:   # parse the bmndr data into %ph0, %sh0, %bh
-            timetuple = time.localtime(x['timestamp'])
+        self.ph1, self.sh1, self.ph0, self.sh0, self.bh = ph1, sh1, ph0, sh0, bh
+        self.start, self.end, self.bflag = start, end, bflag
+
+    def resume(self, ttlf):
+        '''If the last sync got through and the log was only appended to
+        since, carries on from where it stopped instead of parsing the whole
+        log again.'''
+        self.np = 0  # number of lines (pings) in the tagtime log that match
+        self.offset = self.crc = 0  # how much of the log we've read, its crc32
+        self.touched = {}  # days with new matching pings -> a time on that day
+        self.state = None
+        self.newstate = None
+        if not self.bflag and not segments.segmented(ttlf):
+            self.state = read_state(self.statef, ttlf, self.crit)
+        if self.state is not None:
+            self.ph1.update(self.state['ph1'])
+            self.sh1.update(self.state['sh1'])
+            self.np = self.state['np']
+            self.offset, self.crc = self.state['offset'], self.state['crc']
+
+    def tally(self, t, ts, ymd, stuff):
+        '''Counts a line of the log that matches the criterion (at time t,
+        ts being its localtime and ymd its day, with the rest of the line
+        in stuff).'''
+        self.ph1[ymd] += 1
+        self.sh1[ymd] += util.stripb(stuff) + ", "
+        self.np += 1
+        self.touched.setdefault(ymd, t)
+        if t < self.start:
+            self.start = t
+        if t > self.end:
+            self.end = t
+
+    def snapshot(self, offset, crc):
+        '''Remembers the state to carry on from next time, as of offset
+        bytes into the log (whose crc32 is crc).'''
+        self.newstate = {'crit': critkey(self.crit), 'offset': offset,
+                         'crc': crc, 'np': self.np, 'ph1': dict(self.ph1),
+                         'sh1': dict(self.sh1)}
+
+    def write_cache(self, points):
+        '''Writes the .bee cache file, given the datapoints on Beeminder as
+        a dict from day to (pings, comment, bID).'''
+        ping = settings.gap / 3600
+        tmp = '{}.{}'.format(self.beef, os.getpid())
+        with open(tmp, 'w') as f:
+            for ts in sorted(points):
+                y, m, d = re.split(r'-', ts)
+                p, c, b = points[ts]
+                v = p * ping
+                out = '{y} {m} {d}  {v} "{pings}: {c} [bID:{b}]"\n'.format(
+                    y=y, m=m, d=d, v=v, pings=util.splur(p, "ping"), c=c, b=b)
+                f.write(out)
+        os.replace(tmp, self.beef)
+
+    def apply(self, creates, updates, deletes, when):
+        '''Carries out the plan made by sync: creates the datapoints for
+        the given days (when maps each to a time on it) in chunks of
+        CREATE_CHUNK with create_all, then updates and deletes the others.
+        The .bee cache is rewritten to match what's on Beeminder after every
+        chunk, or BATCH updates and deletes, and when anything fails, so an
+        interrupted backfill picks up where it stopped next time.'''
+        ping = settings.gap / 3600
+        beem, slug = self.beem, self.slug
+        ph1, sh1, ph0, sh0, bh = self.ph1, self.sh1, self.ph0, self.sh0, self.bh
+        # what's on beeminder so far: day -> (pings, comment, bID)
+        synced = {ts: (ph0.get(ts, 0), sh0.get(ts, ""), b)
+                  for ts, b in bh.items() if b}
+
+        def comment(ts):
+            return util.splur(ph1[ts], 'ping') + ': ' + sh1[ts]
+
+        def update(ts):
+            beem.update_point(slug, bh[ts], value=(ph1[ts]*ping),
+                              timestamp=when[ts], comment=comment(ts))
+            synced[ts] = ph1[ts], sh1[ts], bh[ts]
+
+        def delete(ts):
+            beem.delete_point(slug, bh[ts])
+            del synced[ts]
+
+        if not (creates or updates or deletes):
+            return
+        try:
+            for i in range(0, len(creates), self.CREATE_CHUNK):
+                chunk = creates[i:i + self.CREATE_CHUNK]
+                # the requestid makes retrying a chunk that did get through
+                # (but whose reply got lost) update the points, not add more
+                points = beem.create_all(slug, [
+                    dict(timestamp=when[ts], value=ph1[ts]*ping,
+                         comment=comment(ts), requestid=ts) for ts in chunk])
+                for ts, point in created(chunk, points):
+                    bh[ts] = point['id']
+                    synced[ts] = ph1[ts], sh1[ts], bh[ts]
+                self.write_cache(synced)
+            rest = [(update, ts) for ts in updates] + \
+                   [(delete, ts) for ts in deletes]
+            for i in range(0, len(rest), self.BATCH):
+                for change, ts in rest[i:i + self.BATCH]:
+                    change(ts)
+                self.write_cache(synced)
+        except BaseException:
+            self.write_cache(synced)
+            raise
+
+    def sync(self):
+        '''Brings the goal on Beeminder, and the .bee cache, in line with
+        the log.'''
+        ping = hours_per_ping = settings.gap / 3600
+        crit = self.crit
+        ph1, sh1, ph0, sh0, bh = self.ph1, self.sh1, self.ph0, self.sh0, self.bh
+        start, end, np, state = self.start, self.end, self.np, self.state
+        touched, newstate, statef = self.touched, self.newstate, self.statef
+
+        # clean up $sh1: trim trailing commas, pipes, and whitespace
+        # for(sort(keys(%sh1))) { $sh1{$_} =~ s/\s*(\||\,)\s*$//; }
+        for key in sorted(sh1.keys()):
+            sh1[key] = re.sub(r'\s*(\||,)\s*$', '', sh1[key])
+
+        #print "Processing datapoints in: ", ts($start), " - ", ts($end), "\n";
+
+        nquo  = 0  # number of datapoints on beeminder with no changes (status quo)
+        ndel  = 0  # number of deleted datapoints on beeminder
+        nadd  = 0  # number of created datapoints on beeminder
+        nchg  = 0  # number of updated datapoints on beeminder
+        minus = 0  # total number of pings decreased from what's on beeminder
+        plus  = 0  # total number of pings increased from what's on beeminder
+        ii    = 0
+        if state is None:
+            days = range(daysnap(start) - 86400, daysnap(end) + 86401, 86400)
+        else:  # the other days were in sync after the last run
+            days = sorted(daysnap(t) for t in touched.values())
+            nquo = sum(1 for ymd in ph1 if ymd not in touched and bh.get(ymd))
+        # First work out the whole plan, then carry it out in bulk.
+        creates, updates, deletes = [], [], []  # days
+        when = {}  # day -> the time of its datapoint
+        for t in days:
+            timetuple = time.localtime(t)
             y, m, d, *rest = timetuple
-            # XXX see note above about generalized midnight
             ts = time.strftime('%Y-%m-%d', timetuple)
-            #t = util.pd(ts)     # XXX isn't x['timestamp'] the unix time anyway already
-            t = x['timestamp']
-            if t < start:
-                start = t
-            if t > end:
-                end = t
-            v = x['value']
-            c = x['comment']
-            b = x['id']
-            i = re.search(r'^\d+', c)
-            ph0[ts] = int(i.group(0) if i else 0) # ping count is first thing in the comment
-            sh0[ts] = re.sub(r'[^:]*:\s+', '', c) # drop the "n pings:" comment prefix
-            # This really shouldn't happen.
-            if ts in bh:
-                raise ValueError(
-                    "Duplicate cached/fetched id datapoints for {ts}: {bhts}, {b}.\n{val}".format(
-                        ts=ts, bhts=bh[ts], b=b, val=pformat(x)))
-            bh[ts] = b
+            when[ts] = t
+            b = bh.get(ts, "")
+            p0 = ph0.get(ts, 0)
+            p1 = ph1.get(ts, 0)
+            s0 = sh0.get(ts, "")
+            s1 = sh1.get(ts, "")
+            if p0 == p1 and s0 == s1: # no change to the datapoint on this day
+                if b:
+                    nquo += 1
+                continue
+            if not b and p1 > 0: # no such datapoint on beeminder: CREATE
+                nadd += 1
+                plus += p1
+                creates.append(ts)
+                #print "Created: $y $m $d  ",$p1*$ping," \"$p1 pings: $s1\"\n";
+            elif p0 > 0 and p1 <= 0: # on beeminder but not in tagtime log: DELETE
+                ndel += 1
+                minus += p0
+                deletes.append(ts)
+                #print "Deleted: $y $m $d  ",$p0*$ping," \"$p0 pings: $s0 [bID:$b]\"\n";
+            elif p0 != p1 or s0 != s1:  # bmndr & tagtime log differ: UPDATE
+                nchg += 1
+                if p1 > p0:
+                    plus += p1 - p0
+                elif p1 < p0:
+                    minus += p0 - p1
+                updates.append(ts)
+                # If this fails, it may well be because the point being updated was deleted/
+                # replaced on another machine (possibly as the result of a merge) and is no
+                # longer on the server. In which case we should probably fail gracefully
+                # rather than failing with an ERROR (see beemupdate()) and not fixing
+                # the problem, which requires manual cache-deleting intervention.
+                # Restarting the script after deleting the offending cache is one option,
+                # though simply deleting the cache file and waiting for next time is less
+                # Intrusive. Deleting the cache files when merging two TT logs would reduce
+                # the scope for this somewhat.
+                #print "Updated:\n";
+                #print "$y $m $d  ",$p0*$ping," \"$p0 pings: $s0 [bID:$b]\" to:\n";
+                #print "$y $m $d  ",$p1*$ping," \"$p1 pings: $s1\"\n";
+            else:
+                print("ERROR: can't tell what to do with this datapoint (old/new):\n")
+                print(ts, p0 * ping, " \"{p0} pings: {s0} [bID:{b}]\"".format(p0=p0, s0=s0, b=b))
+                print(ts, p1 * ping, " \"{p1} pings: {s1}\"\n".format(p1=p1, s1=s1))
+        if state is None and os.path.exists(statef):
+            # apply leaves a .bee cache behind if it fails part way through,
+            # which the old state doesn't go with: scan all of the log again
+            os.remove(statef)
+        self.apply(creates, updates, deletes, when)
+        # generate the new cache file
+        self.write_cache({ts: (ph1[ts], sh1[ts], bh[ts]) for ts in ph1})
+        if newstate is not None and newstate['crit'] is not None:
+            write_state(statef, newstate)
+        elif os.path.exists(statef):
+            os.remove(statef)
+        nd = len(ph1)                 # number of datapoints
+        if nd != nquo + nchg + nadd:  # sanity check
+            print("\nERROR: total != nquo+nchg+nadd ({nd} != {nquo}+{nchg}+{nadd})\n".format(
+                nd=nd, nquo=nquo, nchg=nchg, nadd=nadd))
+
+        print("Datapts: {nd} (~{nquo} *{nchg} +{nadd} -{ndel}), ".format(
+            nd=nd, nquo=nquo, nchg=nchg, nadd=nadd, ndel=ndel),
+              "Pings: {np} (+{plus} -{minus}) ".format(np=np, plus=plus, minus=minus))
+        if isinstance(crit, tagquery.Query):
+            print("w/ query", crit.source)
+        elif isinstance(crit, str):
+            print("w/ tag", crit)
+        elif isinstance(crit, list):
+            print("w/ tags in {", ','.join(crit), "}")
+        elif hasattr(crit, 'search'):
+            print('matching', crit.pattern)
+        elif callable(crit):
+            print('satisfying lambda')
+        else:
+            print("(unknown-criterion: {crit})".format(crit=crit))
+
+
+def scan(ttlf, goals):
+    '''Reads the log once, from where the goal furthest behind stopped
+    last time, and tallies each line for all the goals that haven't seen
+    it yet and whose criteria it matches (see criteria.py).'''
+    matcher = criteria.GoalMatcher({goal: goal.crit for goal in goals})
+
+    def tally(line, goals):
+        m = re.search(r'^(\d+)\s*(.*)$', line)
+        if not m:
+            raise ValueError("Bad line in TagTime log: " + line)
+        t = int(m.group(1)) # timestamp as parsed from the tagtime log
+        ts = time.localtime(t)
+        stuff = m.group(2)  # tags and comments for this line of the log
+        matched = matcher.match(util.strip(stuff), ts)
+        if matched:
+            #print('found a match for line: {}'.format(line))
+            ymd = time.strftime('%Y-%m-%d', ts)
+            for goal in goals:
+                if goal in matched:
+                    goal.tally(t, ts, ymd, stuff)
 
     try:
-        with open(ttlf) as T:
-            np = 0 # number of lines (pings) in the tagtime log that match
-            for line in T: # parse the tagtime log file
-                m = re.search(r'^(\d+)\s*(.*)$', line)
-                if not m:
-                    raise ValueError("Bad line in TagTime log: " + line)
-                t = int(m.group(1)) # timestamp as parsed from the tagtime log
-                ts = time.localtime(t)
-                stuff = m.group(2)  # tags and comments for this line of the log
-                tags = util.strip(stuff)
-                if tagmatch(tags, crit, ts):
-                    #print('found a match for line: {}'.format(line))
-                    #y, m, d, *rest = time.localtime(t)
-                    ymd = time.strftime('%Y-%m-%d', ts)
-                    ph1[ymd] += 1
-                    sh1[ymd] += util.stripb(stuff) + ", "
-                    np += 1
-                    if t < start:
-                        start = t
-                    if t > end:
-                        end = t
+        if segments.segmented(ttlf):
+            for line in segments.lines(ttlf): # parse the tagtime log file
+                tally(line, goals)
+            return
+        first = min(goals, key=lambda goal: goal.offset)
+        offset, crc = first.offset, first.crc
+        furthest = max(goal.offset for goal in goals)
+        encoding = locale.getpreferredencoding(False)
+        with open(ttlf, 'rb') as T:
+            T.seek(offset)
+            for raw in T: # parse the (new part of the) tagtime log file
+                if not raw.endswith(b'\n'):
+                    # an unfinished last line: count it this time, but read
+                    # it again next time
+                    for goal in goals:
+                        goal.snapshot(offset, crc)
+                behind = goals if offset >= furthest else \
+                    [goal for goal in goals if goal.offset <= offset]
+                tally(raw.decode(encoding), behind)
+                if raw.endswith(b'\n'):
+                    offset += len(raw)
+                    crc = zlib.crc32(raw, crc)
+        for goal in goals:
+            if goal.newstate is None:
+                goal.snapshot(offset, crc)
     except IOError:
         raise ValueError("Can't open TagTime log file: "+ttlf)
 
 
-    # clean up $sh1: trim trailing commas, pipes, and whitespace
-    # for(sort(keys(%sh1))) { $sh1{$_} =~ s/\s*(\||\,)\s*$//; }
-    for key in sorted(sh1.keys()):
-        sh1[key] = re.sub(r'\s*(\||,)\s*$', '', sh1[key])
-
-    #print "Processing datapoints in: ", ts($start), " - ", ts($end), "\n";
-
-    nquo  = 0  # number of datapoints on beeminder with no changes (status quo)
-    ndel  = 0  # number of deleted datapoints on beeminder
-    nadd  = 0  # number of created datapoints on beeminder
-    nchg  = 0  # number of updated datapoints on beeminder
-    minus = 0  # total number of pings decreased from what's on beeminder
-    plus  = 0  # total number of pings increased from what's on beeminder
-    ii    = 0
-    for t in range(daysnap(start) - 86400, daysnap(end) + 86401, 86400):
-        timetuple = time.localtime(t)
-        y, m, d, *rest = timetuple
-        ts = time.strftime('%Y-%m-%d', timetuple)
-        b = bh.get(ts, "")
-        p0 = ph0.get(ts, 0)
-        p1 = ph1.get(ts, 0)
-        s0 = sh0.get(ts, "")
-        s1 = sh1.get(ts, "")
-        if p0 == p1 and s0 == s1: # no change to the datapoint on this day
-            if b:
-                nquo += 1
-            continue
-        if not b and p1 > 0: # no such datapoint on beeminder: CREATE
-            nadd += 1
-            plus += p1
-            point = beem.create_point(slug, value=p1*ping,
-                                      timestamp=t, comment=util.splur(p1, 'ping') + ': ' + s1)
-            bh[ts] = point['id']
-            #print "Created: $y $m $d  ",$p1*$ping," \"$p1 pings: $s1\"\n";
-        elif p0 > 0 and p1 <= 0: # on beeminder but not in tagtime log: DELETE
-            ndel += 1
-            minus += p0
-            beem.delete_point(slug, b)
-            #print "Deleted: $y $m $d  ",$p0*$ping," \"$p0 pings: $s0 [bID:$b]\"\n";
-        elif p0 != p1 or s0 != s1:  # bmndr & tagtime log differ: UPDATE
-            nchg += 1
-            if p1 > p0:
-                plus += p1 - p0
-            elif p1 < p0:
-                minus += p0 - p1
-            beem.update_point(slug, b, value=(p1*ping),
-                              timestamp=t,
-                              comment=util.splur(p1, 'ping') + ': ' + s1)
-            # If this fails, it may well be because the point being updated was deleted/
-            # replaced on another machine (possibly as the result of a merge) and is no
-            # longer on the server. In which case we should probably fail gracefully
-            # rather than failing with an ERROR (see beemupdate()) and not fixing
-            # the problem, which requires manual cache-deleting intervention.
-            # Restarting the script after deleting the offending cache is one option,
-            # though simply deleting the cache file and waiting for next time is less
-            # Intrusive. Deleting the cache files when merging two TT logs would reduce
-            # the scope for this somewhat.
-            #print "Updated:\n";
-            #print "$y $m $d  ",$p0*$ping," \"$p0 pings: $s0 [bID:$b]\" to:\n";
-            #print "$y $m $d  ",$p1*$ping," \"$p1 pings: $s1\"\n";
-        else:
-            print("ERROR: can't tell what to do with this datapoint (old/new):\n")
-            print(ts, p0 * ping, " \"{p0} pings: {s0} [bID:{b}]\"".format(p0=p0, s0=s0, b=b))
-            print(ts, p1 * ping, " \"{p1} pings: {s1}\"\n".format(p1=p1, s1=s1))
-    with open(beef, 'w') as f: # generate the new cache file
-        for ts in sorted(ph1.keys()):
-            y, m, d = re.split(r'-', ts)
-            p = ph1[ts]
-            v = p * ping
-            c = sh1[ts]
-            b = bh[ts]
-            out = '{y} {m} {d}  {v} "{pings}: {c} [bID:{b}]"\n'.format(
-                y=y, m=m, d=d, v=v, pings=util.splur(p, "ping"), c=c, b=b)
-            f.write(out)
-    nd = len(ph1)                 # number of datapoints
-    if nd != nquo + nchg + nadd:  # sanity check
-        print("\nERROR: total != nquo+nchg+nadd ({nd} != {nquo}+{nchg}+{nadd})\n".format(
-            nd=nd, nquo=nquo, nchg=nchg, nadd=nadd))
-
-    print("Datapts: {nd} (~{nquo} *{nchg} +{nadd} -{ndel}), ".format(
-        nd=nd, nquo=nquo, nchg=nchg, nadd=nadd, ndel=ndel),
-          "Pings: {np} (+{plus} -{minus}) ".format(np=np, plus=plus, minus=minus))
-    if isinstance(crit, str):
-        print("w/ tag", crit)
-    elif isinstance(crit, list):
-        print("w/ tags in {", ','.join(crit), "}")
-    elif hasattr(crit, 'search'):
-        print('matching', crit.pattern)
-    elif callable(crit):
-        print('satisfying lambda')
+def main():
+    if settings.beemauth is None:
+        usage()
+    if len(sys.argv) in (2, 3) and sys.argv[1] == '--all':
+        ttlf = sys.argv[2] if len(sys.argv) == 3 else settings.logf
+        usrslugs = sorted(settings.beeminder)
+    elif len(sys.argv) == 3:
+        ttlf = sys.argv[1]       # tagtime log filename
+        usrslugs = [sys.argv[2]] # like alice/weight
     else:
-        print("(unknown-criterion: {crit})".format(crit=crit))
+        usage()
+
+    #if(defined(@beeminder)) { # for backward compatibility
+    #  print "Deprecation warning: Get your settings file in line!\n";
+    #  print "Specifically, 'beeminder' should be a hash, not an arry.\n";
+    #  for(@beeminder) {
+    #    @stuff = split(/\s+/, $_); # usrslug and tags
+    #    $us = shift(@stuff);
+    #    $beeminder{$us} = [@stuff];
+    #  }
+    #}
+
+    beems = {}  # one connection per beeminder user
+    goals = []
+    for usrslug in usrslugs:
+        m = re.search(r"^(?:.*?(?:\.\/)?data\/)?([^\+\/\.]*)[\+\/]([^\.]*)", usrslug)
+        if not m:
+            usage()
+        usr, slug = m.groups();
+        crit = settings.beeminder.get(usrslug)
+        if crit is None:
+            raise ValueError("Can't determine which tags match {}".format(usrslug))
+        if usr not in beems:
+            beems[usr] = beemapi.Beeminder(settings.beemauth, usr)
+        goals.append(Goal(usr, slug, crit, beems[usr]))
+
+    if len(goals) == 1:
+        goal, = goals
+        goal.read_cache()
+        goal.resume(ttlf)
+        scan(ttlf, goals)
+        goal.sync()
+        return 0
+
+    failed = set()  # one goal failing shouldn't hold up the others
+
+    def attempt(goal, action, *args):
+        try:
+            action(goal, *args)
+        except Exception as e:
+            print('ERROR syncing {}/{}: {}'.format(goal.usr, goal.slug, e),
+                  file=sys.stderr)
+            failed.add(goal)
+
+    for goal in goals:
+        attempt(goal, Goal.read_cache)
+        if goal not in failed:
+            attempt(goal, Goal.resume, ttlf)
+    ok = [goal for goal in goals if goal not in failed]
+    if ok:
+        scan(ttlf, ok)
+    for goal in ok:
+        print('{}/{}: '.format(goal.usr, goal.slug), end='')
+        attempt(goal, Goal.sync)
+    return 1 if failed else 0
 
 
 def tagmatch(tags, crit, ts):
     '''Whether the given string of space-separated tags matches the given
     criterion.'''
+    if isinstance(crit, tagquery.Query):
+        return crit(tags, ts)
     if isinstance(crit, str):
         return re.search(r'\b{crit}\b'.format(crit=crit), tags)
     if isinstance(crit, list):
@@ -356,6 +569,90 @@ def tagmatch(tags, crit, ts):
             "Criterion {crit} is neither string, array, regex, nor lambda!".format(crit=crit))
         sys.exit(1)
 
+def created(days, points):
+    '''Pairs the days sent to create_all (with their day as requestid)
+    with the datapoints it returned.  Raises ValueError, after yielding
+    the rest, if any of them weren't created.'''
+    if not isinstance(points, list):
+        raise ValueError('Unexpected reply to create_all: {!r}'.format(points))
+    byid = {point.get('requestid'): point for point in points
+            if isinstance(point, dict)}
+    if not any(ts in byid for ts in days):  # no requestids: in order, then
+        byid = dict(zip(days, points))
+    failed = []
+    for ts in days:
+        point = byid.get(ts)
+        if isinstance(point, dict) and point.get('id'):
+            yield ts, point
+        else:
+            failed.append((ts, point))
+    if failed:
+        raise ValueError('create_all failed for {}'.format(
+            ', '.join('{} ({!r})'.format(ts, point) for ts, point in failed)))
+
+
+def critkey(crit):
+    '''A fingerprint of a criterion (and of the time zone, which decides
+    which day pings are on), to tell if it changed since the last sync.
+    None if we can't tell, eg, for lambdas that use other variables.'''
+    if isinstance(crit, tagquery.Query):
+        key = ['query', crit.source]
+    elif isinstance(crit, (str, list)):
+        key = [type(crit).__name__, crit]
+    elif hasattr(crit, 'search') and hasattr(crit, 'pattern'):
+        key = ['re', crit.pattern, crit.flags]
+    elif getattr(crit, '__code__', None) is not None and \
+         all(isinstance(crit.__globals__.get(name, re), types.ModuleType)
+             for name in crit.__code__.co_names):  # only uses modules
+        try:  # and its defaults and closure, if they're plain values
+            captured = marshal.dumps([
+                crit.__defaults__, crit.__kwdefaults__,
+                [cell.cell_contents for cell in crit.__closure__ or ()]])
+        except (ValueError, TypeError):  # eg, a function or an object
+            return None
+        key = ['code', zlib.crc32(marshal.dumps(crit.__code__)),
+               zlib.crc32(captured)]
+    else:
+        return None
+    return key + [list(time.tzname), time.timezone]
+
+
+def read_state(statef, ttlf, crit):
+    '''The state saved by the last sync with the log ttlf (how much of the
+    log it read, the crc32 of that, and the tallies), if we can carry on
+    from it: the criterion must be the same, and the part of the log it
+    read unchanged (crc32 runs at over 1GB/s, so checking all of it costs
+    little next to parsing even the new part).  Otherwise None.'''
+    try:
+        with open(statef) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if state.get('crit') is None or state['crit'] != critkey(crit) or \
+       'crc' not in state:
+        return None
+    crc = 0
+    remaining = state['offset']
+    try:
+        with open(ttlf, 'rb') as f:
+            while remaining:
+                data = f.read(min(remaining, 1 << 20))
+                if not data:  # the log got shorter
+                    return None
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+    except IOError:
+        return None
+    return state if crc == state['crc'] else None
+
+
+def write_state(statef, state):
+    tmp = '{}.{}'.format(statef, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, statef)
+
+
 def daysnap(t):
     '''Convert a timestamp to noon on the same day.  This matters because
     if you start with some timestamp and try to step forward 24 hours at a
@@ -368,4 +665,4 @@ def daysnap(t):
 # $string = do {local (@ARGV,$/) = $file; <>}; # slurp file into string
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+'''
+Startup benchmarks for the tagtime entry points.
+
+Every ping runs several of these processes back to back, so how fast they
+start is what decides how snappy a popup feels.  For each of tagtimed.py,
+launch.py, ping.py and beeminder.py, and for synthetic logs of 1k, 100k
+and 1M pings, this measures the wall time of a cold start, the peak RSS,
+and (with python -X importtime) which imports the time goes to.
+
+Everything runs against a sandboxed HOME with a generated .pytagtimerc, so
+your own settings and log are never touched, and no windows pop up (xt and
+ed are /bin/true); the ping table and other caches go in the sandbox too.
+Results are compared against a baseline stored in ~/.cache/pytagtime and
+the exit status is 1 if anything got slower or bigger than the tolerance
+allows.
+
+    $ ./bench_startup.py                   # run and compare to the baseline
+    $ ./bench_startup.py --update          # run and store a new baseline
+    $ ./bench_startup.py --sizes 1000 -n 3 # just the small log, 3 runs each
+'''
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import rand
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+BASELINE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'pytagtime', 'bench_baseline.json')
+SIZES = [1000, 100000, 1000000]
+TAGS = ['work', 'email', 'meeting', 'code', 'eat', 'sleep', 'afk', 'off',
+        'read', 'fun', 'job', 'exercise', 'RETRO']
+
+# What each entry point is run as.  tagtimed.py runs forever, so for it we
+# time what the daemon does before it goes to sleep for the first time.
+ENTRY_POINTS = {
+    'tagtimed.py': ['-c', 'import time, tagtimed, launch; '
+                    'from settings import settings; '
+                    'settings.rand.prevping(time.time()); launch.run()'],
+    'launch.py': ['launch.py'],
+    'ping.py': ['ping.py', '{lstping}'],
+    'beeminder.py': ['beeminder.py'],  # no args: settings, then usage
+}
+STDIN = {'ping.py': b'bench\n'}
+
+SETTINGS = '''\
+user = 'bench'
+path = {path!r}
+logf = {logf!r}
+gap = {gap!r}
+seed = 666
+xt = '/bin/true'
+ed = '/bin/true'
+playsound = ''
+'''
+
+
+def make_sandbox(root, size):
+    '''Makes a HOME directory with a settings file and a log of the given
+    number of pings, ending with the last ping before now.  Returns the
+    environment to run in and the time of the last ping.'''
+    home = os.path.join(root, str(size))
+    os.makedirs(home)
+    now = time.time()
+    # shrink the gap if need be so that many pings fit since 2007
+    gap = min(45*60, int((now - rand.BIRTH) / size * 0.8))
+    logf = os.path.join(home, 'bench.log')
+    with open(os.path.join(home, '.pytagtimerc'), 'w') as f:
+        f.write(SETTINGS.format(path=HERE, logf=logf, gap=gap))
+    pings = rand.ExpRand(seed=666, gap=gap).schedule(rand.BIRTH, now)
+    pings = [int(ping) for ping in pings[-size:]]
+    rng = random.Random(size)
+    with open(logf, 'w') as f:
+        for ping in pings:
+            tags = ' '.join(rng.sample(TAGS, rng.randint(1, 3)))
+            f.write('{} {} [{}]\n'.format(ping, tags, time.strftime(
+                '%Y-%m-%d %H:%M:%S %a', time.localtime(ping))))
+    shutil.copy(logf, logf + '.orig')
+    env = dict(os.environ, HOME=home, XDG_CACHE_HOME=os.path.join(home, '.cache'))
+    env.pop('PYTAGTIMERC', None)
+    return env, logf, pings[-1]
+
+
+def run(args, env, stdin=None):
+    '''Runs python with the given args, returning the wall time in seconds
+    and the stderr output.'''
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable] + args, cwd=HERE, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    _, err = proc.communicate(stdin)
+    elapsed = time.perf_counter() - start
+    return elapsed, err.decode(errors='replace')
+
+
+# Runs an entry point and reports its peak RSS on stderr when it exits.  The
+# peak is read from /proc (VmHWM) because ru_maxrss from wait4 would also
+# count this (much bigger) process, which the child is forked from.
+RSS_WRAPPER = '''
+import atexit, runpy, sys
+def hwm():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                sys.stderr.write('PEAKRSS ' + line.split()[1] + '\\n')
+atexit.register(hwm)
+sys.argv = sys.argv[1:]
+if sys.argv[0] == '-c':
+    sys.argv = sys.argv[1:]
+    exec(sys.argv[0])
+else:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def peak_rss(args, env, stdin=None):
+    '''Peak RSS in KB of a single run.'''
+    if not os.path.exists('/proc/self/status'):
+        proc = subprocess.Popen([sys.executable] + args, cwd=HERE, env=env,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        proc.stdin.write(stdin or b'')
+        proc.stdin.close()
+        _, _, usage = os.wait4(proc.pid, 0)
+        proc.returncode = 0  # so Popen doesn't try to reap it again
+        return usage.ru_maxrss
+    _, err = run(['-c', RSS_WRAPPER] + args, env, stdin)
+    for line in err.splitlines():
+        if line.startswith('PEAKRSS '):
+            return int(line.split()[1])
+    raise RuntimeError('No peak RSS reported by: {}\n{}'.format(args, err))
+
+
+def importtimes(stderr):
+    '''Parses python -X importtime output into {module: (self us, cumulative us)}.'''
+    result = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selftime, cumulative, name = line[len('import time:'):].split('|')
+        result[name.strip()] = (int(selftime), int(cumulative))
+    return result
+
+
+def bench(sizes, repeats):
+    results = {}
+    root = tempfile.mkdtemp(prefix='tagtime-bench-')
+    local = {os.path.splitext(f)[0] for f in os.listdir(HERE) if f.endswith('.py')}
+    try:
+        for size in sizes:
+            env, logf, lstping = make_sandbox(root, size)
+            for name, args in ENTRY_POINTS.items():
+                args = [arg.format(lstping=lstping) for arg in args]
+                stdin = STDIN.get(name)
+                shutil.copy(logf + '.orig', logf)
+                run(args, env, stdin)  # warm up the caches (ping table etc)
+                times = []
+                for i in range(repeats):
+                    shutil.copy(logf + '.orig', logf)
+                    times.append(run(args, env, stdin)[0])
+                shutil.copy(logf + '.orig', logf)
+                rss = peak_rss(args, env, stdin)
+                shutil.copy(logf + '.orig', logf)
+                _, err = run(['-X', 'importtime'] + args, env, stdin)
+                imports = importtimes(err)
+                ours = {mod: imports[mod][1] for mod in imports if mod in local}
+                slowest = sorted(imports.items(), key=lambda item: -item[1][0])[:5]
+                key = '{} {}'.format(name, size)
+                results[key] = {
+                    'wall': statistics.median(times),
+                    'rss': rss,
+                    'imports': sum(t for t, _ in imports.values()),
+                    'local_imports': ours,
+                    'slowest_imports': {mod: t for mod, (t, _) in slowest},
+                }
+                print('{:<22} wall {:7.1f}ms  rss {:7d}KB  imports {:6.1f}ms'.format(
+                    key, results[key]['wall'] * 1000, rss,
+                    results[key]['imports'] / 1000))
+                for mod, t in sorted(ours.items(), key=lambda item: -item[1]):
+                    print('{:>30} {:6.1f}ms'.format(mod, t / 1000))
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Returns the list of regressions against the baseline.'''
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric in ['wall', 'rss']:
+            old, new = baseline[key][metric], result[metric]
+            if new > old * (1 + tolerance):
+                regressions.append('{} {}: {} -> {} (+{:.0%})'.format(
+                    key, metric, old, new, new / old - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the startup of the tagtime entry points.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='log sizes (in pings) to test with')
+    parser.add_argument('-n', '--repeats', type=int, default=5,
+                        help='timed runs per entry point and log size')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='file the baseline is stored in')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown before failing (0.25 = 25%%)')
+    parser.add_argument('--update', action='store_true',
+                        help='store these results as the new baseline')
+    args = parser.parse_args()
+
+    results = bench(args.sizes, args.repeats)
+    if args.update or not os.path.exists(args.baseline):
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)),
+                    exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline written to', args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION:', regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
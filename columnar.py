@@ -0,0 +1,206 @@
+'''
+A columnar binary mirror of a TagTime log, kept next to it, for analytics
+that would otherwise re-parse every line of the log on every run:
+
+    <log>.times   int64 timestamp of each ping
+    <log>.tagptr  int64, ping i's tag ids are tagids[tagptr[i]:tagptr[i+1]]
+    <log>.tagids  int32 tag ids (CSR style, like scipy's sparse matrices)
+    <log>.tags    the tag for each tag id, one per line
+    <log>.cols    header: which log (size and mtime) this describes, and
+                  how much of each file above is valid
+
+With mirrors = True in .pytagtimerc, the Logger appends to the mirror as
+it appends to the log; otherwise it's built when it's read.  If anything
+else changes the log, the mirror is rebuilt the next time it's read.  The
+columns load straight into numpy with np.memmap (see Columns.arrays), eg,
+to count pings per tag per week (see Columns.tally).
+'''
+
+import array
+import locale
+import os
+import struct
+
+from logparse import Ping
+
+# magic, log size, log mtime_ns, bytes of the log mirrored, pings, tag ids, tags
+HEADER = struct.Struct('=8sqqqqqq')
+
+
+class Columns:
+
+    MAGIC = b'TTCOLS01'
+
+    def __init__(self, logf):
+        self.logf = logf
+        self.stamp = None   # (size, mtime_ns) of the log the mirror is for
+        self.end = 0        # bytes of the log mirrored (only whole lines)
+        self.npings = 0
+        self.ntagids = 0
+        self.tags = []      # tag id -> tag
+        self.tagid = {}     # tag -> tag id
+
+    def path(self, column):
+        return '{}.{}'.format(self.logf, column)
+
+    def _logstamp(self):
+        try:
+            st = os.stat(self.logf)
+        except FileNotFoundError:
+            return 0, 0
+        return st.st_size, st.st_mtime_ns
+
+    def _reset(self):
+        self.stamp = None
+        self.end = self.npings = self.ntagids = 0
+        self.tags = []
+        self.tagid = {}
+
+    def load(self, stamp=None):
+        '''Reads the header and the tags.  Returns whether the mirror is
+        there and describes the log as it is now (or, given a (size,
+        mtime_ns) stamp, as it was then).'''
+        try:
+            with open(self.path('cols'), 'rb') as f:
+                magic, size, mtime, end, npings, ntagids, ntags = \
+                    HEADER.unpack(f.read(HEADER.size))
+            with open(self.path('tags'), encoding='utf-8') as f:
+                tags = f.read().split('\n')[:ntags]
+            sizes = [os.path.getsize(self.path(column))
+                     for column in ['times', 'tagptr', 'tagids']]
+        except (IOError, struct.error):
+            return False
+        if magic != self.MAGIC or len(tags) != ntags or \
+           any(size < valid for size, valid in
+               zip(sizes, [8 * npings, 8 * (npings + 1), 4 * ntagids])) or \
+           (size, mtime) != (stamp or self._logstamp()):
+            return False
+        self.stamp = size, mtime
+        self.end, self.npings, self.ntagids = end, npings, ntagids
+        self.tags = tags
+        self.tagid = {tag: i for i, tag in enumerate(tags)}
+        return True
+
+    def _encode(self, data):
+        '''Parses whole lines of the log (bytes) into columns to append,
+        interning any new tags.  Returns (times, tag ends, tag ids, new
+        tags).'''
+        encoding = locale.getpreferredencoding(False)
+        times = array.array('q')
+        ends = array.array('q')
+        ids = array.array('i')
+        newtags = []
+        for line in data.splitlines():
+            ping = Ping.parse(line.decode(encoding, 'replace'))
+            if ping is None:
+                continue
+            times.append(ping.time)
+            for tag in ping.tags:
+                if tag not in self.tagid:
+                    self.tagid[tag] = len(self.tags)
+                    self.tags.append(tag)
+                    newtags.append(tag)
+                ids.append(self.tagid[tag])
+            ends.append(self.ntagids + len(ids))
+        return times, ends, ids, newtags
+
+    def _header(self):
+        return HEADER.pack(self.MAGIC, self.stamp[0], self.stamp[1], self.end,
+                           self.npings, self.ntagids, len(self.tags))
+
+    def _append(self, times, ends, ids, newtags):
+        '''Appends to the columns, cutting off anything past what the header
+        says is valid first (eg, left by a crash), then writes the header.'''
+        columns = [('times', times, self.npings),
+                   ('tagptr', ends, self.npings + 1),
+                   ('tagids', ids, self.ntagids)]
+        for column, values, valid in columns:
+            with open(self.path(column), 'r+b') as f:
+                f.truncate(valid * values.itemsize)
+                f.seek(0, os.SEEK_END)
+                f.write(values.tobytes())
+        if newtags:
+            with open(self.path('tags'), 'a', encoding='utf-8') as f:
+                f.write(''.join(tag + '\n' for tag in newtags))
+        self.npings += len(times)
+        self.ntagids += len(ids)
+        with open(self.path('cols'), 'r+b') as f:
+            f.write(self._header())
+
+    def rebuild(self):
+        '''Parses the whole log and writes a fresh mirror of it.'''
+        self._reset()
+        self.stamp = self._logstamp()
+        try:
+            with open(self.logf, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        self.end = data.rfind(b'\n') + 1  # up to the last whole line
+        times, ends, ids, _ = self._encode(data[:self.end])
+        try:
+            for column, values in [('times', times),
+                                   ('tagptr', array.array('q', [0]) + ends),
+                                   ('tagids', ids)]:
+                with open(self.path(column), 'wb') as f:
+                    f.write(values.tobytes())
+            with open(self.path('tags'), 'w', encoding='utf-8') as f:
+                f.write(''.join(tag + '\n' for tag in self.tags))
+            self.npings, self.ntagids = len(times), len(ids)
+            with open(self.path('cols'), 'wb') as f:
+                f.write(self._header())
+        except IOError:
+            pass  # it's only a mirror; we'll just have to parse again
+
+    def current(self):
+        '''Makes sure the mirror describes the log as it is now.'''
+        if self.stamp != self._logstamp() and not self.load():
+            self.rebuild()
+
+    def appended(self, before, data, fd):
+        '''Called by the Logger after it appended data (bytes, whole lines)
+        to the log, open as fd, which was (size, mtime_ns) before just
+        before.  Appends the new pings to the mirror if it described the
+        log as it was then; otherwise (eg, the log was edited in place, or
+        there's no mirror yet) it'll be rebuilt when it's next needed.'''
+        if (self.stamp != before and not self.load(before)) or \
+           self.end != before[0]:
+            return
+        offset = before[0]
+        st = os.fstat(fd)
+        if st.st_size != offset + len(data):
+            return  # someone else appended meanwhile
+        columns = self._encode(data)
+        self.stamp = st.st_size, st.st_mtime_ns
+        self.end = st.st_size
+        try:
+            self._append(*columns)
+        except IOError:
+            self._reset()
+
+    def arrays(self):
+        '''Returns the times, tagptr and tagids columns as (read-only,
+        memory-mapped) numpy arrays.'''
+        import numpy  # slow to import, and not needed just to log
+        self.current()
+        columns = [('times', numpy.int64, self.npings),
+                   ('tagptr', numpy.int64, self.npings + 1),
+                   ('tagids', numpy.int32, self.ntagids)]
+        return [numpy.memmap(self.path(column), dtype=dtype, mode='r',
+                             shape=(n,))
+                if n else numpy.zeros(0, dtype=dtype)
+                for column, dtype, n in columns]
+
+    def tally(self, edges):
+        '''Counts the pings with each tag in each of the time intervals
+        [edges[i], edges[i+1]).  Returns an array indexed by [interval, tag
+        id]; multiply it by gap/3600 for hours.'''
+        import numpy
+        times, tagptr, tagids = self.arrays()
+        nbins, ntags = len(edges) - 1, len(self.tags)
+        bins = numpy.searchsorted(edges, times, side='right') - 1
+        bins = numpy.repeat(bins, numpy.diff(tagptr))  # one per tag id
+        inside = (bins >= 0) & (bins < nbins)
+        counts = numpy.bincount(bins[inside] * ntags + tagids[inside],
+                                minlength=nbins * ntags)
+        return counts.reshape(nbins, ntags)
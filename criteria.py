@@ -0,0 +1,164 @@
+'''
+Matching a line of the log against the criteria of all the Beeminder goals
+(settings.beeminder) at once, instead of one goal at a time.
+
+The criteria are the same as beeminder.tagmatch takes, with the same
+meaning, but compiled once when the matcher is made:
+
+  * Strings and lists of strings that are plain words (like "job") go in an
+    inverted index from word to goals.  A line is split into its runs of
+    word characters once, and each run is looked up, since r'\bjob\b' only
+    matches a run of word characters that is exactly "job".
+  * Other strings, and the rest of a list, become one regex per goal
+    (r'\b(?:a|b)\b' for a list).  These, and re.compile()d criteria, are
+    also combined into one big alternation that's tried first, so a line
+    that matches none of them costs a single search.
+  * Queries (see tagquery.py) get the set of tags, split just once.
+  * Lambdas are simply called.
+
+Since a log has far fewer distinct tag strings than lines, what each tag
+string matches is remembered (in a bounded LRU cache), so repeats cost a
+dict lookup.  Lambdas are called with the time too, so they're only
+cached if declared not to need it, or to need only the weekday:
+
+    beeminder = {'dan/nafk': timeless(lambda tags, ts: 'afk' not in tags),
+                 'dave/tue': per_weekday(lambda tags, ts: ts.tm_wday == 1)}
+
+Other lambdas are called for every line.  Queries declare themselves.
+'''
+
+import collections
+import re
+
+import tagquery
+
+WORD = re.compile(r'\w+')
+DEFAULT_FLAGS = re.compile('').flags
+
+# what of the time a criterion looks at -> the part of ts to key the cache on
+TSKEYS = collections.OrderedDict([
+    ('timeless', lambda ts: None),
+    ('weekday', lambda ts: ts.tm_wday),
+    ('hour', lambda ts: (ts.tm_wday, ts.tm_hour)),
+])
+
+
+def timeless(function):
+    '''Declares that a lambda criterion ignores ts, so its results can be
+    cached by tag string alone.'''
+    function.tskey = 'timeless'
+    return function
+
+
+def per_weekday(function):
+    '''Declares that a lambda criterion only looks at ts.tm_wday.'''
+    function.tskey = 'weekday'
+    return function
+
+
+class GoalMatcher:
+
+    CACHE_SIZE = 4096  # distinct tag strings (times weekdays, etc) remembered
+
+    def __init__(self, criteria, cache_size=CACHE_SIZE):
+        '''criteria maps goals (anything hashable, eg, "alice/work") to
+        their criteria.  Raises ValueError for a criterion that's not a
+        string, list, regex, query or lambda.'''
+        self.index = {}        # word -> goals whose criteria include it
+        self.regexes = []      # (goal, compiled regex), in the prefilter
+        self.unfiltered = []   # (goal, compiled regex), not in it
+        self.queries = []      # (goal, Query)
+        self.lambdas = []      # (goal, function)
+        self.uncached = []     # (goal, Query or function) that need all of ts
+        tskeys = ['timeless']
+        for goal, crit in criteria.items():
+            # lambdas that haven't said what of ts they use might use it all
+            tskey = getattr(crit, 'tskey',
+                            None if callable(crit) else 'timeless')
+            if tskey not in TSKEYS:
+                self.uncached.append((goal, crit))
+                continue
+            tskeys.append(tskey)
+            if isinstance(crit, tagquery.Query):
+                self.queries.append((goal, crit))
+            elif isinstance(crit, (str, list)):
+                patterns = []
+                for c in [crit] if isinstance(crit, str) else crit:
+                    if WORD.fullmatch(c):
+                        self.index.setdefault(c, []).append(goal)
+                    else:
+                        patterns.append(c)
+                if patterns:
+                    self._add_regex(goal, re.compile(
+                        r'\b(?:{})\b'.format('|'.join(patterns))))
+            elif callable(crit):
+                self.lambdas.append((goal, crit))
+            elif hasattr(crit, 'search'):
+                self._add_regex(goal, crit)
+            else:
+                raise ValueError('Criterion {!r} for {} is neither string, '
+                                 'array, regex, query nor lambda'.format(
+                                     crit, goal))
+        self.prefilter = None
+        if self.regexes:
+            self.prefilter = re.compile('|'.join(
+                '(?:{})'.format(regex.pattern) for _, regex in self.regexes))
+        # the cache is keyed on as much of ts as the finest criterion needs
+        self.tskey = TSKEYS[max(tskeys, key=list(TSKEYS).index)]
+        self.cache = collections.OrderedDict()  # (tags, part of ts) -> goals
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
+
+    def _add_regex(self, goal, regex):
+        # Only patterns without groups (whose numbers would shift, breaking
+        # backreferences) or flags can be combined into the prefilter.
+        if regex.groups == 0 and regex.flags == DEFAULT_FLAGS and \
+           isinstance(regex.pattern, str):
+            self.regexes.append((goal, regex))
+        else:
+            self.unfiltered.append((goal, regex))
+
+    def match(self, tags, ts):
+        '''The set of goals whose criteria the given string of tags (as
+        util.strip leaves them), at time ts (a time.struct_time), matches.'''
+        key = tags, self.tskey(ts)
+        matched = self.cache.get(key)
+        if matched is None:
+            self.misses += 1
+            matched = self.cache[key] = frozenset(self._match(tags, ts))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        if not self.uncached:
+            return matched
+        matched = set(matched)
+        for goal, crit in self.uncached:
+            if goal not in matched and crit(tags, ts):
+                matched.add(goal)
+        return matched
+
+    def _match(self, tags, ts):
+        matched = set()
+        if self.index:
+            for word in set(WORD.findall(tags)):
+                goals = self.index.get(word)
+                if goals:
+                    matched.update(goals)
+        if self.prefilter is not None and self.prefilter.search(tags):
+            for goal, regex in self.regexes:
+                if goal not in matched and regex.search(tags):
+                    matched.add(goal)
+        for goal, regex in self.unfiltered:
+            if goal not in matched and regex.search(tags):
+                matched.add(goal)
+        if self.queries:
+            tagset = set(tags.split())
+            for goal, query in self.queries:
+                if goal not in matched and query(tagset, ts):
+                    matched.add(goal)
+        for goal, function in self.lambdas:
+            if goal not in matched and function(tags, ts):
+                matched.add(goal)
+        return matched
@@ -3,150 +3,180 @@
 '''
 Check if it's time (or past time) to ping. If so, catch up on missed pings
 and/or launch ping.py for the current ping.
-This should be called by the daemon (tagtimed.py) every time a ping is due.
+The daemon (tagtimed.py) calls run() in-process every time a ping is due;
+running this script does the same thing once.
 '''
 
 import datetime
-import subprocess
 import time
 
 from settings import settings
+from logparse import Ping
 import util
 
 import os
 import sys
 import re
 
-rand = settings.rand
-logger = settings.logger
 
-test = 'test' in sys.argv
-quiet = 'quiet' in sys.argv
-
-launchtime = time.time()
-
-
-def editor(f, t):
+def editor(f, t, settings=settings):
     '''Launch an editor to edit file f, labeling the window with title t.'''
     if not os.environ.get('DISPLAY', None):
         os.environ['DISPLAY'] = ':0.0'  # must set explicitly if run from cron
     cmd = settings.get_edit_cmd(f, t)
-    util.callcmd(cmd)
+    util.callcmd(cmd, env=childenv(settings))
+
+
+def childenv(settings):
+    '''The environment for processes we start, which tells them (eg,
+    ping.py) which settings file to use.'''
+    return dict(os.environ, PYTAGTIMERC=settings.srcpath)
 
 
 # Launch the tagtime pinger for the given time (in unix time).
-def launch(t):
+def launch(t, settings=settings):
     lt = time.localtime(t)
     hour, min, sec = ('{:02}'.format(i) for i in [lt.tm_hour, lt.tm_min, lt.tm_sec])
     # os.environ['DISPLAY'] = ':0.0' # have to set this explicitly if
     # invoked by cron.
-    util.playsound()
+    util.playsound(settings)
     pingpath = os.path.join(settings.path, 'ping.py')
     cmd = settings.get_xt_cmd(
         'TagTime {hour}:{min}:{sec}'.format(hour=hour, min=min, sec=sec),
         pingpath, str(t))
-    util.callcmd(cmd)
-
-
-def lastln():
-    '''Returns the last line in the log but as a 2-tuple
-    consisting of timestamp and rest of the line.'''
-    x = None
-    with open(settings.logf) as f:
-        for x in f:
-            pass
-    m = re.search(r'^\s*(\d+)\s*(.*)$', x)
-    if m:
-        return int(m.group(1)), m.group(2)
-    return None, None
-
-
-if test:  # just pop up the editor and exit; mainly for testing.
-    editor(settings.logf, "TagTime Log Editor " +
-           "(invoked explicitly with \"test\" arg)")
-    sys.exit(0)
-
-# figure out the next ping after the last one that's in the log file
-if os.path.exists(settings.logf):
-    lll = subprocess.check_output(['tail', '-1', settings.logf])  # last line
-    # parse out the timestamp for the last line, which better
-    # be equal to nextping@prevping of itself.
-    m = re.search(br'^\s*(\d+)', lll)
-    lstping = int(m.group(1)) if m is not None else 0
-
-    tmp = rand.nextping(rand.prevping(lstping))
-    # NB: must call prevping before nextping
-
-    if lstping == tmp:
-        nxtping = rand.nextping(lstping)
-    else:
-        # XXX configurable encoding
+    util.callcmd(cmd, env=childenv(settings))
+
+
+def lastping(settings=settings):
+    '''Returns the last line in the log as a Ping (see logparse.py), or
+    None if there isn't one.'''
+    x = settings.logger.last_line()
+    return Ping.parse(x) if x is not None else None
+
+
+def pings_after_log(launchtime, settings=settings):
+    '''Returns a cursor (see ExpRand.iter_pings) at the next ping after the
+    last one that's in the log file, or at the last ping before launchtime
+    if the log doesn't end with a scheduled ping.'''
+    rand = settings.rand
+    if os.path.exists(settings.logger.logf):
+        lll = settings.logger.last_line() or ''  # last line
+        # parse out the timestamp for the last line, which better
+        # be a scheduled ping.
+        m = re.search(r'^\s*(\d+)', lll)
+        lstping = int(m.group(1)) if m is not None else 0
+
+        if next(rand.iter_pings(after=lstping - 1))[0] == lstping:
+            return rand.iter_pings(after=lstping)
         print("TagTime log file ({logf}) has bad last line:\n{lll}".format(
-            logf=settings.logf, lll=lll.decode('ascii')))
-        nxtping = rand.prevping(launchtime)
-else:
-    nxtping = rand.prevping(launchtime)
-
-# XXX locking
-# if(!lockn()) {
-#    print "Can't get lock. Exiting.\n" unless $quiet;
-#    exit(1);
-# } # Don't wait if we can't get the lock.
-
-editorflag = False
-
-# First, if we missed any pings by more than $retrothresh seconds for no
-# apparent reason, then assume the computer was off and auto-log them.
-while nxtping < launchtime - settings.retrothresh:
-    line = "{nxtping} afk off RETRO".format(nxtping=nxtping)
-    logger.log(util.annotime(line, nxtping))
-    nxtping = rand.nextping(nxtping)
-    editorflag = True
-
-# # Next, ping for any pings in the last retrothresh seconds.
-while True:
-    while nxtping <= time.time():
-        if nxtping < time.time() - settings.retrothresh:
-            line = util.annotime('{} afk RETRO'.format(nxtping),
-                                 nxtping) + "\n"
-            logger.log(line)
-            editorflag = True
-        else:
-            launch(nxtping)  # this shouldn't complete till you answer
-
-        ts, ln = lastln()
-        if ts != nxtping:  # in case, eg, we closed the window w/o answering.
-            # suppose there's a ping window waiting (call it ping 1),
-            # and while it's sitting there unanswered another ping
-            # (ping 2) pings.  then you kill the ping 1 window.  the
-            # editor will then pop up for you to fix the err ping but
-            # there will be nothing in the log yet for ping 2.
-            # perhaps that's ok, just thinking out loud here...
-            logger.log(util.annotime(
-                '{nxtping} err [missed ping from {pingdelta} ago]'.format(
-                    nxtping=nxtping,
-                    pingdelta=datetime.timedelta(seconds=time.time()-nxtping)),
-                nxtping
-            ))
-            editor(settings.logf,
-                   'TagTime Log Editor (unanswered pings logged as "err")')
-            editorflag = False
-        elif not ln.strip():  # no tags in last line of log.
-            # editor(settings.logf,
-            # "TagTime Log Editor (add tags for last ping)")
-            editorflag = True
-        lstping = nxtping
-        nxtping = rand.nextping(nxtping)
-        # Here's where we would add an artificial gap of $nxtping-$lstping.
-    if editorflag:
-        editor(settings.logf, "TagTime Log Editor (fill in your RETRO pings)")
-        # when editor finishes there may be new pings missed!
-        # that's why we have the outer do-while loop here, to start over if
-        # there are new pings in the past after we finish editing.
-    if nxtping > time.time():
-        break
-
-util.unlock()
+            logf=settings.logger.logf, lll=lll))
+    lstping, _ = rand.walk(launchtime)
+    return rand.iter_pings(after=lstping - 1)
+
+
+def due(settings=settings):
+    '''Whether the next ping after the last one in the log is already due.
+    False if the log doesn't end with a scheduled ping (run() sorts that
+    out).'''
+    lll = settings.logger.last_line() or ''
+    m = re.search(r'^\s*(\d+)', lll)
+    if m is None:
+        return False
+    lstping = int(m.group(1))
+    rand = settings.rand
+    if next(rand.iter_pings(after=lstping - 1))[0] != lstping:
+        return False
+    return next(rand.iter_pings(after=lstping))[0] <= time.time()
+
+
+def run(settings=settings):
+    '''Catch up on missed pings and launch the popup for any pings that
+    are due, until there are no more pings in the past.  This only
+    walks the schedule with its own cursor, so it's safe to call from
+    another thread while the daemon is using settings.rand.'''
+    launchtime = time.time()
+    rand = settings.rand
+    logger = settings.logger
+    pings = pings_after_log(launchtime, settings)
+    nxtping, _ = next(pings)
+
+    # XXX locking
+    # if(!lockn()) {
+    #    print "Can't get lock. Exiting.\n" unless $quiet;
+    #    exit(1);
+    # } # Don't wait if we can't get the lock.
+
+    editorflag = False
+
+    # First, if we missed any pings by more than $retrothresh seconds for no
+    # apparent reason, then assume the computer was off and auto-log them.
+    # All of them are generated in one go and written with a single write.
+    retro = []
+    if nxtping < launchtime - settings.retrothresh:
+        retro = rand.schedule(nxtping, launchtime - settings.retrothresh)
+    if len(retro):
+        logger.log_many(
+            util.annotime("{nxtping} afk off RETRO".format(nxtping=ping), ping,
+                          settings.linelen)
+            for ping in map(int, retro))
+        pings = rand.iter_pings(after=int(retro[-1]))
+        nxtping, _ = next(pings)
+        editorflag = True
+
+    # # Next, ping for any pings in the last retrothresh seconds.
+    while True:
+        while nxtping <= time.time():
+            if nxtping < time.time() - settings.retrothresh:
+                line = util.annotime('{} afk RETRO'.format(nxtping),
+                                     nxtping, settings.linelen) + "\n"
+                logger.log(line)
+                editorflag = True
+            else:
+                launch(nxtping, settings)  # this shouldn't complete till you answer
+
+            last = lastping(settings)
+            if last is None or last.time != nxtping:  # in case, eg, we closed the window w/o answering.
+                # suppose there's a ping window waiting (call it ping 1),
+                # and while it's sitting there unanswered another ping
+                # (ping 2) pings.  then you kill the ping 1 window.  the
+                # editor will then pop up for you to fix the err ping but
+                # there will be nothing in the log yet for ping 2.
+                # perhaps that's ok, just thinking out loud here...
+                logger.log(util.annotime(
+                    '{nxtping} err [missed ping from {pingdelta} ago]'.format(
+                        nxtping=nxtping,
+                        pingdelta=datetime.timedelta(seconds=time.time()-nxtping)),
+                    nxtping, settings.linelen
+                ))
+                editor(settings.logger.logf,
+                       'TagTime Log Editor (unanswered pings logged as "err")',
+                       settings)
+                editorflag = False
+            elif not (last.tags or last.comment):  # nothing in last line of log.
+                # editor(settings.logf,
+                # "TagTime Log Editor (add tags for last ping)")
+                editorflag = True
+            lstping = nxtping
+            nxtping, _ = next(pings)
+            # Here's where we would add an artificial gap of $nxtping-$lstping.
+        if editorflag:
+            editor(settings.logger.logf, "TagTime Log Editor (fill in your RETRO pings)",
+                   settings)
+            # when editor finishes there may be new pings missed!
+            # that's why we have the outer do-while loop here, to start over if
+            # there are new pings in the past after we finish editing.
+        if nxtping > time.time():
+            break
+
+    util.unlock()
+
+
+if __name__ == '__main__':
+    if 'test' in sys.argv:  # just pop up the editor and exit; mainly for testing.
+        editor(settings.logger.logf, "TagTime Log Editor " +
+               "(invoked explicitly with \"test\" arg)")
+        sys.exit(0)
+    run()
 
 # SCHDEL (SCHEDULED FOR DELETION): (discussion and code for artificial gaps)
 # It can happen that 2 pings can both occur since we last checked (a minute
@@ -1,13 +1,161 @@
+import contextlib
+import locale
+import os
+import threading
+
+from columnar import Columns
+from logindex import LogIndex
+
+
 class Logger:
 
-    def __init__(self, logf, linelen = 80):
+    BLOCKSIZE = 4096  # how much of the log to read at a time from the end
+
+    # When to fsync the log: never, after every write (which holds a whole
+    # batch of lines), or after every single line.
+    FSYNC_MODES = ('none', 'batch', 'line')
+
+    def __init__(self, logf, linelen = 80, fsync='batch', mirrors=False):
         self.logf = logf
         self.linelen = linelen
+        self.fsync = fsync
+        self._fd = None      # kept open, in append mode
+        self._batch = None   # lines waiting to be written, inside batch()
+        self._lock = threading.RLock()
+        self.index = LogIndex(logf)
+        self.columns = Columns(logf)  # see columnar.py
+        # whether appends update the index and columns as they go
+        self.mirrors = [self.index, self.columns] if mirrors else []
+
+    @classmethod
+    def check_fsync(cls, fsync):
+        if fsync not in cls.FSYNC_MODES:
+            raise ValueError('fsync must be one of {}, not {!r}'.format(
+                ', '.join(cls.FSYNC_MODES), fsync))
+
+    @property
+    def fsync(self):
+        return self._fsync
+
+    @fsync.setter
+    def fsync(self, fsync):
+        self.check_fsync(fsync)
+        self._fsync = fsync
+
+    def _open(self):
+        '''Returns the descriptor for appending to the log, (re)opening it if
+        the log was replaced (eg, by an editor saving a new copy of it) or
+        removed since.'''
+        if self._fd is not None:
+            try:
+                st = os.stat(self.logf)
+            except FileNotFoundError:
+                st = None
+            fst = os.fstat(self._fd)
+            if st is None or (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino):
+                self.close()
+        if self._fd is None:
+            self._fd = os.open(self.logf, os.O_WRONLY | os.O_APPEND |
+                               os.O_CREAT | getattr(os, 'O_CLOEXEC', 0), 0o666)
+        return self._fd
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _write(self, lines):
+        '''Appends the given lines to the log with a single write(2), so
+        that they can't be interleaved with lines other processes append at
+        the same time, and fsyncs according to self.fsync.'''
+        if self.fsync == 'line' and len(lines) > 1:
+            for line in lines:
+                self._write([line])
+            return
+        data = ''.join(lines).encode(locale.getpreferredencoding(False))
+        with self._lock:
+            fd = self._open()
+            if self.mirrors:
+                st = os.fstat(fd)
+                before = st.st_size, st.st_mtime_ns  # for them to check
+            written = os.write(fd, data)
+            while written < len(data):  # only for very big batches
+                written += os.write(fd, data[written:])
+            if self.fsync != 'none':
+                os.fsync(fd)
+            for mirror in self.mirrors:
+                mirror.appended(before, data, fd)
 
     def log(self, s):
         '''append a string to the log file'''
-        if s and s[-1] != '\n':
-            s = s + '\n'
-        with open(self.logf, 'a') as f:
-            f.write(s)
+        self.log_many([s])
     slog = log # original name
+
+    def log_many(self, lines):
+        '''append several lines to the log file with a single write'''
+        lines = [line if line[-1] == '\n' else line + '\n'
+                 for line in lines if line]
+        if not lines:
+            return
+        with self._lock:
+            if self._batch is not None:
+                self._batch.extend(lines)
+                return
+        self._write(lines)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group commit: everything logged inside a `with logger.batch():`
+        block is appended with a single write (and fsync) at the end.'''
+        with self._lock:
+            if self._batch is not None:  # already in a batch
+                yield self
+                return
+            self._batch = []
+            try:
+                yield self
+            finally:
+                lines, self._batch = self._batch, None
+                if lines:
+                    self._write(lines)
+
+    def tail(self, n=1):
+        '''Returns the last n lines of the log, as iterating over the file
+        would return them (ie, with their newlines).  This seeks backwards
+        from the end of the file a block at a time, so it costs the same no
+        matter how long the log is.'''
+        try:
+            f = open(self.logf, 'rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b''
+            # n lines need n newlines before them, not counting the
+            # one at the very end of the file
+            while pos > 0 and data.count(b'\n', 0, len(data) - 1) < n:
+                size = min(self.BLOCKSIZE, pos)
+                pos -= size
+                f.seek(pos)
+                data = f.read(size) + data
+        if not data:
+            return []
+        lines = data.split(b'\n')
+        last = lines.pop()  # after the final newline, usually empty
+        lines = [line + b'\n' for line in lines]
+        if last:
+            lines.append(last)
+        encoding = locale.getpreferredencoding(False)
+        return [line.decode(encoding) for line in lines[-n:]]
+
+    def last_line(self):
+        '''Returns the last line of the log, or None if the log is empty or
+        doesn't exist.'''
+        lines = self.tail(1)
+        return lines[0] if lines else None
+
+    def between(self, a, b):
+        '''Yields the lines of the log with timestamps in [a, b), using the
+        sparse index (see logindex.py) to skip straight to them.'''
+        return self.index.between(a, b)
@@ -0,0 +1,170 @@
+'''
+A sparse index of a TagTime log, kept next to it in <log>.idx: the
+timestamp and byte offset of every EVERY-th line.  Reading the pings
+between two times is then a bisect plus a seek instead of a scan of the
+whole log.
+
+With mirrors = True in .pytagtimerc, the Logger adds to the index as it
+appends to the log; otherwise it's built when it's read.  The index also
+records the size and mtime of the log it describes, so if anything else
+changes the log (eg, editing it) the index is rebuilt the next time it's
+read.  Logs are assumed to be in chronological order, as tagtime writes
+them.
+'''
+
+import array
+import bisect
+import locale
+import os
+import re
+import struct
+
+HEADER = struct.Struct('=8sqqqqq')  # magic, every, size, mtime_ns, nlines, complete
+ENTRY = struct.Struct('=qq')        # timestamp, offset
+
+
+class LogIndex:
+
+    MAGIC = b'TTLOGIX1'
+    EVERY = 256  # lines per index entry
+
+    def __init__(self, logf, every=EVERY):
+        self.logf = logf
+        self.idxf = logf + '.idx'
+        self.every = every
+        self.stamp = None    # (size, mtime_ns) of the log the index is for
+        self.nlines = 0      # number of complete lines in the log
+        self.complete = True # whether the log ends with a newline
+        self.times = array.array('q')
+        self.offsets = array.array('q')
+
+    def _logstamp(self):
+        try:
+            st = os.stat(self.logf)
+        except FileNotFoundError:
+            return 0, 0
+        return st.st_size, st.st_mtime_ns
+
+    @staticmethod
+    def _time(line, default):
+        m = re.match(br'\s*(\d+)', line)
+        return int(m.group(1)) if m else default
+
+    def load(self, stamp=None):
+        '''Reads the index file.  Returns whether it's there and describes
+        the log as it is now (or, given a (size, mtime_ns) stamp, as it was
+        then).'''
+        try:
+            with open(self.idxf, 'rb') as f:
+                data = f.read()
+            magic, every, size, mtime, nlines, complete = \
+                HEADER.unpack_from(data)
+        except (IOError, struct.error):
+            return False
+        nentries = -(-nlines // every)
+        if (magic, every) != (self.MAGIC, self.every) or \
+           len(data) != HEADER.size + nentries * ENTRY.size or \
+           (size, mtime) != (stamp or self._logstamp()):
+            return False
+        entries = array.array('q', data[HEADER.size:])
+        self.times, self.offsets = entries[0::2], entries[1::2]
+        self.stamp = size, mtime
+        self.nlines = nlines
+        self.complete = bool(complete)
+        return True
+
+    def rebuild(self):
+        '''Scans the whole log and writes a fresh index for it.'''
+        self.times = array.array('q')
+        self.offsets = array.array('q')
+        self.nlines = 0
+        self.complete = True
+        offset = 0
+        last = 0
+        try:
+            with open(self.logf, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        self.complete = False
+                        break
+                    last = self._time(line, last)
+                    if self.nlines % self.every == 0:
+                        self.times.append(last)
+                        self.offsets.append(offset)
+                    self.nlines += 1
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        self.stamp = self._logstamp()
+        self._save()
+
+    def _header(self):
+        return HEADER.pack(self.MAGIC, self.every, self.stamp[0],
+                           self.stamp[1], self.nlines, self.complete)
+
+    def _save(self):
+        entries = array.array('q', [0]) * (2 * len(self.times))
+        entries[0::2], entries[1::2] = self.times, self.offsets
+        tmp = '{}.{}'.format(self.idxf, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self._header())
+                f.write(entries.tobytes())
+            os.replace(tmp, self.idxf)
+        except IOError:
+            pass  # it's only an index
+
+    def current(self):
+        '''Makes sure the index describes the log as it is now.'''
+        if self.stamp != self._logstamp() and not self.load():
+            self.rebuild()
+
+    def appended(self, before, data, fd):
+        '''Called by the Logger after it appended data (bytes, whole lines)
+        to the log, open as fd, which was (size, mtime_ns) before just
+        before.  Adds any new entries to the index if it described the log
+        as it was then; otherwise it'll be rebuilt when it's next needed.'''
+        if self.stamp != before and not self.load(before):
+            return  # out of date, maybe edited in place
+        offset = before[0]
+        st = os.fstat(fd)
+        if st.st_size != offset + len(data) or not self.complete:
+            return  # someone else appended meanwhile
+        start = len(self.times)
+        last = self.times[-1] if self.times else 0
+        for line in data.splitlines(True):
+            last = self._time(line, last)
+            if self.nlines % self.every == 0:
+                self.times.append(last)
+                self.offsets.append(offset)
+            self.nlines += 1
+            offset += len(line)
+        self.stamp = st.st_size, st.st_mtime_ns
+        entries = array.array('q', [0]) * (2 * (len(self.times) - start))
+        entries[0::2] = self.times[start:]
+        entries[1::2] = self.offsets[start:]
+        try:
+            with open(self.idxf, 'r+b') as f:
+                f.seek(HEADER.size + start * ENTRY.size)
+                f.write(entries.tobytes())
+                f.seek(0)
+                f.write(self._header())
+        except IOError:
+            self.stamp = None
+
+    def between(self, a, b):
+        '''Yields the lines of the log with timestamps in [a, b).'''
+        self.current()
+        i = max(0, bisect.bisect_left(self.times, a) - 1)
+        if not self.offsets:
+            return
+        encoding = locale.getpreferredencoding(False)
+        last = 0
+        with open(self.logf, 'rb') as f:
+            f.seek(self.offsets[i])
+            for line in f:
+                last = self._time(line, last)
+                if last >= b:
+                    break
+                if last >= a:
+                    yield line.decode(encoding)
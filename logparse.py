@@ -0,0 +1,206 @@
+'''
+Parsing lines of a TagTime log.  These don't depend on the settings, so
+that the logger and the files it keeps next to the log can use them too.
+'''
+
+import re
+
+# The tag intern table: one shared copy of each tag, and one shared tuple
+# for each combination of tags, for the whole process.  Pings with the same
+# tags then share them, and tags can be compared with `is`.
+TAGS = {}
+TAGSETS = {}
+
+
+# The characters that open and close comments, and that the scanners below
+# jump between, so the text in between is only looked at by re (in C).
+PARENS = re.compile(r'[()]')
+BRACKETS = re.compile(r'[\[\]]')
+DELIMITERS = re.compile(r'[()\[\]]')
+
+
+def _pairs(s, delimiters, opener):
+    '''The spans (start, end) of the outermost matched pairs of the given
+    delimiters in s, eg, of parens.  This is what repeatedly deleting the
+    innermost pairs would delete, found in a single pass with a stack.'''
+    opens = []   # positions of the openers not closed yet
+    spans = []   # matched pairs so far, innermost ones replaced by outer
+    for m in delimiters.finditer(s):
+        i = m.start()
+        if s[i] == opener:
+            opens.append(i)
+        elif opens:
+            start = opens.pop()
+            while spans and spans[-1][0] > start:  # inside this pair
+                spans.pop()
+            spans.append((start, i + 1))
+    return spans
+
+
+def _cut(s, spans):
+    '''s without the given (ordered, disjoint) spans.'''
+    if not spans:
+        return s
+    pieces = []
+    i = 0
+    for start, end in spans:
+        pieces.append(s[i:start])
+        i = end
+    pieces.append(s[i:])
+    return ''.join(pieces)
+
+
+def strip(s):
+    '''Strips out stuff in parens and brackets;
+    remaining parens/brackets means they were unmatched.
+
+    This gives the same result as deleting innermost pairs of parens until
+    there are none, then brackets (as the perl version did with regexes),
+    but in linear time however deeply they're nested.
+    '''
+    s = _cut(s, _pairs(s, PARENS, '('))
+    s = _cut(s, _pairs(s, BRACKETS, '['))
+    # Also remove trailing whitespace? (this breaks cntpings)
+    # s = re.sub(r'\s*$', '', s)
+
+    return s
+
+def stripb(s):
+    '''Strips out stuff in brackets only; remaining brackets means
+    they were unmatched.
+
+    Same as re.sub(r'\s*\[[^\[\]]*\]', '', s), ie, only innermost brackets,
+    along with the whitespace before them, but without the regex's quadratic
+    time on long runs of whitespace.'''
+    spans = []
+    opener = None  # the last [ with no bracket after it yet
+    for m in BRACKETS.finditer(s):
+        i = m.start()
+        if s[i] == '[':
+            opener = i
+        elif opener is not None:
+            start = opener
+            while start > 0 and s[start - 1].isspace():
+                start -= 1
+            spans.append((start, i + 1))
+            opener = None
+    return _cut(s, spans)
+
+
+def stripc(s):
+    '''Strips out stuff *not* in parens and brackets.'''
+    pairs = {
+        '(': ')',
+        '[': ']'
+    }
+    reverse_pairs = {val: key for (key, val) in pairs.items()}
+
+    result = []
+    openers = []
+    for m in DELIMITERS.finditer(s):
+        i = m.start()
+        if s[i] in pairs:
+            openers.append(i)
+        elif openers and s[openers[-1]] == reverse_pairs[s[i]]:
+            start = openers.pop()
+            if not openers:  # closed all parens
+                result.append(s[start:i+1])
+            # else ignore/continue, will be appended to the
+            # result when the last parens is closed
+        # else unmatched closer, ignore
+    return(''.join(result))
+
+# Here is the original perl implementation
+# sub stripc {
+#   my($s) = @_;
+#   my $tmp = $s;
+#   while($tmp =~ s/\([^\(\)]*\)/UNIQUE78DIV/g) {}
+#   while($tmp =~ s/\[[^\[\]]*\]/UNIQUE78DIV/g) {}
+#   my @a = split('UNIQUE78DIV', $tmp);
+#   for(@a) {
+#     my $i = index($s, $_);
+#     substr($s, $i, length($_)) = "";
+#   }
+#   return $s;
+# }
+
+
+def tags(s):
+    '''The tags in (the rest of, after the timestamp) a log line: the
+    words left after stripping out the comments in parens and brackets.'''
+    return strip(s).split()
+
+
+LINE = re.compile(r'\s*(\d+)\s*(.*)')
+
+def scan(line):
+    '''Parses a line of the log in one go, in linear time.  Returns
+    (timestamp, tags, comments, unmatched): the tags as a list (as tags()
+    returns them), the comments as stripc() does, and whether there were
+    unmatched parens or brackets; or None if there's no timestamp.'''
+    m = LINE.match(line)
+    if not m:
+        return None
+    rest = m.group(2)
+    stripped = strip(rest)
+    return (int(m.group(1)), stripped.split(), stripc(rest),
+            DELIMITERS.search(stripped) is not None)
+
+
+def scan_lines(lines):
+    '''Yields scan(line) for each of the lines (eg, an open log file).'''
+    for line in lines:
+        yield scan(line)
+
+
+def intern_tags(tags):
+    '''Returns the shared tuple (see TAGSETS) of the given tags.'''
+    key = tuple(tags)
+    try:
+        return TAGSETS[key]
+    except KeyError:
+        tagset = tuple(TAGS.setdefault(tag, tag) for tag in key)
+        TAGSETS[tagset] = tagset
+        return tagset
+
+
+class Ping:
+    '''A parsed line of the log: its timestamp, its tags (an interned
+    tuple, see intern_tags) and its comments (what was in parens and
+    brackets).  There can be a lot of these, hence the __slots__.'''
+
+    __slots__ = ('time', 'tags', 'comment')
+
+    def __init__(self, time, tags=(), comment=''):
+        self.time = time
+        self.tags = intern_tags(tags)
+        self.comment = comment
+
+    @classmethod
+    def parse(cls, line):
+        '''Returns a Ping for the given line of the log, or None if it
+        doesn't start with a timestamp.'''
+        scanned = scan(line)
+        if scanned is None:
+            return None
+        t, tags, comments, _ = scanned
+        return cls(t, tags, comments)
+
+    def __eq__(self, other):
+        return isinstance(other, Ping) and (self.time, self.tags, self.comment) \
+            == (other.time, other.tags, other.comment)
+
+    def __hash__(self):
+        return hash((self.time, self.tags, self.comment))
+
+    def __repr__(self):
+        return 'Ping({!r}, {!r}, {!r})'.format(self.time, self.tags,
+                                                self.comment)
+
+
+def pings(lines):
+    '''Yields a Ping for each line (that starts with a timestamp).'''
+    for line in lines:
+        ping = Ping.parse(line)
+        if ping is not None:
+            yield ping
@@ -8,9 +8,11 @@
 # each other and it remembers that order for next time! That's gonna rock.
 
 from settings import settings
+from logparse import Ping
 import util
 import ansi
 
+import os
 import re
 import time
 import sys
@@ -19,10 +21,12 @@ logger = settings.logger
 
 eflag = 0  # Error flag
 
-# Send pings to the given beeminder goal, e.g. passing "alice/foo" sends
-# appropriate (as defined in .tagtimerc) pings to bmndr.com/alice/foo
-def bm(s):
-    cmd = [os.path.join(settings.path, "beeminder.py"), settings.logf, s]
+# Send pings to all the beeminder goals, e.g. for "alice/foo" send the
+# appropriate (as defined in .tagtimerc) pings to bmndr.com/alice/foo.
+# This is a single beeminder.py process, which reads the log just once.
+def bm():
+    global eflag
+    cmd = [os.path.join(settings.path, "beeminder.py"), "--all", settings.logf]
     if not util.callcmd(cmd):
         eflag += 1
 
@@ -31,20 +35,15 @@ def bm(s):
 # Timestamps and comments are removed.
 # On error, throws an exception.
 def get_last_doing():
-    with open(settings.logf, 'r') as f:
-        last = list(f)[-1]
-    respm = re.search(r'''
-^
-    \d+      # Timestamp
-    \s+      # Spaces after timestamp
-    (.*)         # Om nom nom
-                      ''', last, re.X)
-
-    if not respm:
+    last = logger.last_line()
+    if last is None:
+        raise ValueError('TagTime log is empty')
+    ping = Ping.parse(last)
+    if ping is None:
         print("ERROR: Failed to find any tags for ditto function. "
               "Last line in TagTime log:\n", last, file=sys.stderr)
         sys.exit(1)
-    return util.strip(respm.group(1)).strip()  # remove comments and timestamps
+    return ' '.join(ping.tags)  # without the timestamp and comments
 
 
 pingtime = time.time()
@@ -183,9 +182,7 @@ logger.log(a)
 #   (maybe should do this after retro pings too but launch.pl would do that).
 if settings.beeminder and resp:
     print(util.divider(" sending your tagtime data to beeminder "))
-    for key in settings.beeminder:
-        print(key)
-        bm(key)
+    bm()
     if eflag:
         print('{}, press enter to dismiss...'.format(util.splur(eflag, 'error')))
         tmp = input()
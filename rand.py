@@ -1,4 +1,26 @@
+import array
+import bisect
 import math
+import mmap
+import os
+import struct
+import threading
+
+numpy = False  # imported when first needed; None if it isn't installed
+
+def load_numpy():
+    '''Imports numpy (which is slow to import, and not needed just to
+    ping) the first time it's needed.  Returns None if there's no numpy.'''
+    global numpy
+    if numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+BIRTH = 1184083200  # the birth of timepie/tagtime!
+TABLE_END = 2208988800  # 2040-01-01, how far the ping table goes
 
 class Random:
 
@@ -25,19 +47,77 @@ class Random:
         '''Returns a U(0,1) random number.'''
         return float(self.ran0()) / self.IM
 
+    def seed_at(self, k):
+        '''Returns the RNG state after k steps from the initial seed,
+        without changing self.seed.  Since ran0 is a pure multiplicative
+        generator this is a single modular exponentiation.'''
+        return pow(self.IA, k, self.IM) * self.initseed % self.IM
+
+    def skip(self, k):
+        '''Move the PRNG state forward k times in O(log k) and return
+        the new state.'''
+        self.seed = pow(self.IA, k, self.IM) * self.seed % self.IM
+        return self.seed
+
     def ranx(self, x):
         '''Move the PRNG state forward x times and return the result'''
-        result = None
-        for i in range(x):
-            result = self.ran01()
-        return result or (self.seed / self.IM)
+        return self.skip(max(0, x)) / self.IM
+
+
+class PingTable:
+    '''
+    Every scheduled ping time from the birth of tagtime to TABLE_END for
+    one seed and gap, stored as an array of int64s in a file that is
+    memory-mapped, so that all tagtime processes on the machine share a
+    single copy through the page cache.  Ping number i is self.pings[i].
+    '''
+    MAGIC = b'TTPINGS1'
+    HEADER = struct.Struct('=8sqdq')  # magic, seed, gap, number of pings
+
+    def __init__(self, path, seed, gap):
+        self.path = path
+        self.seed = seed
+        self.gap = gap
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fseed, fgap, count = self.HEADER.unpack_from(self._mmap)
+        if (magic, fseed, fgap) != (self.MAGIC, seed, gap) or \
+           len(self._mmap) != self.HEADER.size + 8 * count:
+            self._mmap.close()
+            raise ValueError('Bad ping table: {}'.format(path))
+        self.pings = memoryview(self._mmap)[self.HEADER.size:].cast('q')
+
+    def __len__(self):
+        return len(self.pings)
+
+    @staticmethod
+    def write(path, seed, gap, pings):
+        '''Atomically writes the given ping times to a table file.'''
+        pings = array.array('q', pings)
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(PingTable.HEADER.pack(PingTable.MAGIC, seed, gap,
+                                          len(pings)))
+            f.write(pings.tobytes())
+        os.replace(tmp, path)
+
+    def covers(self, t):
+        '''Whether every ping before time t is in the table.'''
+        return t <= self.pings[-1]
 
 
 class ExpRand(Random):
 
-    def __init__(self, seed, gap):
+    # Number of pings between two entries of the checkpoint table.
+    CHECKPOINT_EVERY = 1000
+
+    def __init__(self, seed, gap, cachedir=None):
         super().__init__(seed)
         self.gap = gap
+        self.cachedir = cachedir  # where to keep the checkpoint file
+        self._checkpoints = None
+        self._table = None
+        self._lock = threading.Lock()  # guards the checkpoint/ping tables
 
     def exprand(self):
         '''
@@ -51,22 +131,228 @@ class ExpRand(Random):
         Takes previous ping time, returns random next ping time (unixtime).
         NB: this has the side effect of changing the RNG state ($seed)
         and so should only be called once per next ping to calculate,
-        after calling prevping.
+        after calling prevping.  (iter_pings has no such restriction.)
         '''
         return max(prev + 1, round(prev + self.exprand()))
         # Note: round1 used in the perl version has the same behavior
 
-    def prevping(self, t):
-        '''Computes the last scheduled ping time before time t.'''
-        self.seed = self.initseed
-        # Starting at the beginning of time, walk forward computing
-        # next pings until the next ping is >= t.
-        nxtping = 1184083200  # the birth of timepie/tagtime!
+    def step(self, prev, seed):
+        '''Like nextping, but takes the RNG state explicitly instead of
+        using (and changing) self.seed.  Returns the next ping time and
+        the new RNG state.'''
+        seed = self.IA * seed % self.IM
+        exprand = -1 * self.gap * math.log(float(seed) / self.IM)
+        return max(prev + 1, round(prev + exprand)), seed
+
+    def checkpointf(self):
+        '''The file the checkpoint table for this seed and gap is kept in,
+        or None if the table should only be kept in memory.'''
+        if self.cachedir is None:
+            return None
+        return os.path.join(self.cachedir, '.tagtime-{}-{}.ckpt'.format(
+            self.initseed, self.gap))
+
+    def tablef(self):
+        '''The file the ping table for this seed and gap is kept in,
+        or None if there is no table.'''
+        if self.cachedir is None:
+            return None
+        return os.path.join(self.cachedir, '.tagtime-{}-{}.pings'.format(
+            self.initseed, self.gap))
+
+    def _load_table(self):
+        '''Opens the ping table, (re)generating it if it is missing or
+        was made for another seed or gap.'''
+        f = self.tablef()
+        if f is None:
+            return None
+        try:
+            return PingTable(f, self.initseed, self.gap)
+        except (IOError, ValueError, struct.error):
+            pass
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            PingTable.write(f, self.initseed, self.gap,
+                            self._generate(BIRTH, self.initseed, TABLE_END))
+            return PingTable(f, self.initseed, self.gap)
+        except (IOError, ValueError):
+            return None  # no table, walk from the checkpoints instead
+
+    def table(self):
+        '''Returns the shared ping table, or None if there is none.'''
+        with self._lock:
+            if self._table is None and self.cachedir is not None:
+                self._table = self._load_table() or False
+            return self._table or None
+
+    def _header(self):
+        return '{} {} {}'.format(self.initseed, self.gap, self.CHECKPOINT_EVERY)
+
+    def _load_checkpoints(self):
+        '''Returns the checkpoint table: a list of (ping time, RNG state)
+        pairs for every CHECKPOINT_EVERY-th ping since the birth of
+        tagtime.  Entry i is ping number i * CHECKPOINT_EVERY.'''
+        checkpoints = [(BIRTH, self.initseed)]
+        f = self.checkpointf()
+        if f is None:
+            return checkpoints
+        try:
+            with open(f) as ckpt:
+                if ckpt.readline().strip() != self._header():
+                    return checkpoints
+                for line in ckpt:
+                    ping, seed = line.split()
+                    checkpoints.append((int(ping), int(seed)))
+        except (IOError, ValueError):
+            # A missing or garbled table is just rebuilt from scratch.
+            return [(BIRTH, self.initseed)]
+        # Every ping consumes exactly one ran0 step, so the RNG state at
+        # checkpoint i is known without replaying anything.
+        for i, (ping, seed) in enumerate(checkpoints):
+            if seed != self.seed_at(i * self.CHECKPOINT_EVERY):
+                return checkpoints[:i]
+        return checkpoints
+
+    def _save_checkpoints(self):
+        f = self.checkpointf()
+        if f is None:
+            return
+        tmp = '{}.{}'.format(f, os.getpid())
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            with open(tmp, 'w') as ckpt:
+                ckpt.write(self._header() + '\n')
+                for ping, seed in self._checkpoints[1:]:
+                    ckpt.write('{} {}\n'.format(ping, seed))
+            os.replace(tmp, f)
+        except IOError:
+            pass  # the table is only a cache
+
+    def walk(self, t):
+        '''Returns the last scheduled ping time before time t together
+        with the RNG state at that ping, without changing self.seed.'''
+        with self._lock:
+            return self._walk(t)
+
+    def _walk(self, t):
+        if self._table is None and self.cachedir is not None:
+            self._table = self._load_table() or False
+        if self._table and self._table.covers(t):
+            # The ping number is all we need to know the RNG state.
+            i = max(0, bisect.bisect_left(self._table.pings, t) - 1)
+            return self._table.pings[i], self.seed_at(i)
+        if self._checkpoints is None:
+            self._checkpoints = self._load_checkpoints()
+        checkpoints = self._checkpoints
+        # Start from the last checkpoint before t instead of the
+        # beginning of time, then walk forward computing next pings
+        # until the next ping is >= t.
+        i = max(0, bisect.bisect_left(checkpoints, (t,)) - 1)
+        nxtping, seed = checkpoints[i]
+        n = i * self.CHECKPOINT_EVERY  # number of nxtping since BIRTH
         lstping = nxtping
-        lstseed = self.seed
+        lstseed = seed
+        extended = False
         while nxtping < t:
             lstping = nxtping
-            lstseed = self.seed
-            nxtping = self.nextping(nxtping)
-        self.seed = lstseed
+            lstseed = seed
+            nxtping, seed = self.step(nxtping, seed)
+            n += 1
+            if n == len(checkpoints) * self.CHECKPOINT_EVERY:
+                checkpoints.append((nxtping, seed))
+                extended = True
+        if extended:
+            self._save_checkpoints()
+        return lstping, lstseed
+
+    def iter_pings(self, after):
+        '''Yields (ping time, RNG state) for every scheduled ping after
+        time `after`, forever.  Unlike nextping this doesn't use or change
+        self.seed, so any number of these cursors can walk the schedule at
+        once, from any thread.'''
+        ping, seed = self.walk(math.floor(after) + 1)  # last ping <= after
+        if ping > after:  # `after` is before the birth of tagtime
+            yield ping, seed
+        while True:
+            ping, seed = self.step(ping, seed)
+            yield ping, seed
+
+    def _powers(self, n):
+        '''Returns a numpy array of IA**k mod IM for k = 1..n.'''
+        powers = numpy.empty(n, dtype=numpy.int64)
+        powers[0] = self.IA
+        k = 1
+        while k < n:
+            m = min(k, n - k)
+            # all values are < 2**31, so the products fit in an int64
+            powers[k:k + m] = powers[:m] * powers[k - 1] % self.IM
+            k += m
+        return powers
+
+    def _bulk(self, prev, seed, n):
+        '''Returns the n pings following ping prev (with RNG state seed) as
+        a numpy array, and the RNG state at the last of them.'''
+        seeds = seed * self._powers(n) % self.IM
+        exprand = -1 * self.gap * numpy.log(seeds / self.IM)
+        incr = numpy.maximum(numpy.floor(exprand + 0.5), 1).astype(numpy.int64)
+        pings = prev + numpy.cumsum(incr)
+        # round() rounds half to even, and numpy's log may differ from
+        # math.log in the last bit, so whenever the exponential draw is
+        # anywhere near a half we redo that ping exactly as nextping would.
+        frac = exprand - numpy.floor(exprand)
+        fixes = numpy.zeros(n, dtype=numpy.int64)
+        shift = 0  # sum of the fixes so far
+        for j in numpy.flatnonzero(numpy.abs(frac - 0.5) < 1e-6):
+            if j:
+                ping, _ = self.step(int(pings[j - 1]) + shift, int(seeds[j - 1]))
+            else:
+                ping, _ = self.step(prev, seed)
+            fix = ping - (int(pings[j]) + shift)
+            fixes[j] = fix
+            shift += fix
+        if fixes.any():
+            pings += numpy.cumsum(fixes)
+        return pings, int(seeds[-1])
+
+    def _generate(self, ping, seed, end):
+        '''Returns ping and every ping after it that comes before end, as
+        a numpy int64 array if numpy is available or else as a list.'''
+        numpy = load_numpy()
+        if numpy is None:
+            pings = []
+            while ping < end:
+                pings.append(ping)
+                ping, seed = self.step(ping, seed)
+            return pings
+        chunks = [numpy.array([ping], dtype=numpy.int64)]
+        while ping < end:
+            n = min(1 << 16, int((end - ping) / self.gap * 1.1) + 16)
+            pings, seed = self._bulk(ping, seed, n)
+            chunks.append(pings)
+            ping = int(pings[-1])
+        pings = numpy.concatenate(chunks)
+        return pings[pings < end]
+
+    def schedule(self, start, end):
+        '''Returns every scheduled ping time in [start, end), exactly as
+        repeated calls to nextping would compute them.  The result is a
+        numpy int64 array, or a list if numpy is not available.  Does not
+        change self.seed.'''
+        numpy = load_numpy()
+        table = self.table()
+        if table and table.covers(end):
+            i = bisect.bisect_left(table.pings, start)
+            j = bisect.bisect_left(table.pings, end)
+            if numpy is None:
+                return table.pings[i:j].tolist()
+            return numpy.frombuffer(table.pings[i:j], dtype=numpy.int64)
+        ping, seed = self.walk(start)
+        pings = self._generate(ping, seed, end)
+        if numpy is None:
+            return [ping for ping in pings if ping >= start]
+        return pings[pings >= start]
+
+    def prevping(self, t):
+        '''Computes the last scheduled ping time before time t.'''
+        lstping, self.seed = self.walk(t)
         return lstping
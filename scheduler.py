@@ -0,0 +1,56 @@
+'''
+Scheduling pings for several users from one daemon (see tagtimed.py).
+
+Users are grouped by their ping schedule, ie, by (seed, gap).  Each
+distinct schedule is walked once, with one ExpRand (and so one ping table)
+and one cursor, and every ping is handed to all the users on it, so memory
+and wakeups grow with the number of distinct schedules, not users.
+'''
+
+import heapq
+
+
+class Schedule:
+    '''One distinct ping schedule and the users on it.'''
+
+    def __init__(self, rand, after):
+        self.rand = rand
+        self.cursor = rand.iter_pings(after=after)
+        self.users = []
+        self.nxtping, _ = next(self.cursor)
+
+    def advance(self):
+        self.nxtping, _ = next(self.cursor)
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.schedules = {}  # (seed, gap) -> Schedule
+        self.heap = []       # (nxtping, (seed, gap)), one per schedule
+
+    def add(self, settings, after):
+        '''Adds a user (a Settings object) whose pings after time `after`
+        should be scheduled.  Users with the same seed and gap as an
+        earlier user share its ExpRand.'''
+        key = (settings.seed, settings.gap)
+        if key not in self.schedules:
+            self.schedules[key] = Schedule(settings.rand, after)
+            heapq.heappush(self.heap, (self.schedules[key].nxtping, key))
+        schedule = self.schedules[key]
+        settings.rand = schedule.rand
+        schedule.users.append(settings)
+
+    def nextping(self):
+        '''The time of the next ping for any user, or None if there are
+        no users.'''
+        return self.heap[0][0] if self.heap else None
+
+    def pop(self):
+        '''Returns the next ping time and the list of users it's for, and
+        moves that schedule on to its following ping.'''
+        nxtping, key = self.heap[0]
+        schedule = self.schedules[key]
+        schedule.advance()
+        heapq.heapreplace(self.heap, (schedule.nxtping, key))
+        return nxtping, schedule.users
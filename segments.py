@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+'''
+Keeping a TagTime log as one file per year (or month), optionally.
+
+With segments = 'year' in .pytagtimerc, the log <logf> is kept as
+<logf>.d/2017.log, <logf>.d/2018.log, etc, plus <logf>.d/manifest.json
+with the time range and number of lines of each segment.  Appending only
+touches the latest segment, the editor only opens that one, and reading a
+time range skips the segments outside it.  A segment that was changed
+behind our back (eg, edited) is rescanned when the manifest is next used.
+
+To split an existing log into segments, or join them up again:
+
+    $ ./segments.py import ~/tagtime/alice.log year
+    $ ./segments.py export ~/tagtime/alice.log alice-all.log
+'''
+
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from logger import Logger
+
+PERIODS = {'year': '%Y', 'month': '%Y-%m'}  # segment names
+MANIFEST = 'manifest.json'
+
+
+def segdir(logf):
+    return logf + '.d'
+
+
+def segmented(logf):
+    '''Whether the log logf is kept in segments.'''
+    return os.path.exists(os.path.join(segdir(logf), MANIFEST))
+
+
+def linetime(line, default):
+    m = re.match(r'\s*(\d+)', line)
+    return int(m.group(1)) if m else default
+
+
+class SegmentedLog:
+    '''A log kept in segments, with the same interface as a Logger.'''
+
+    def __init__(self, logf, period='year', linelen=80, fsync='batch',
+                 mirrors=False):
+        if period not in PERIODS:
+            raise ValueError('segments must be one of {}, not {!r}'.format(
+                ', '.join(PERIODS), period))
+        self.base = logf
+        self.dir = segdir(logf)
+        self.manifestf = os.path.join(self.dir, MANIFEST)
+        self.period = period
+        self.linelen = linelen
+        Logger.check_fsync(fsync)
+        self._fsync = fsync
+        self.mirrors = mirrors
+        self._loggers = {}    # segment name -> Logger
+        self.segments = {}    # segment name -> its entry in the manifest
+        self._batch = None
+        self._lock = threading.RLock()
+        self._manifest_stamp = None  # (size, mtime_ns) when last read
+        self._load()
+
+    def _load(self):
+        '''Merges in the manifest on disk, which other processes appending
+        to the log may have changed since we last read it.  Of two entries
+        for a segment, the one that matches the segment file wins.'''
+        try:
+            st = os.stat(self.manifestf)
+            if [st.st_size, st.st_mtime_ns] == self._manifest_stamp:
+                return
+            with open(self.manifestf) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return
+        self._manifest_stamp = [st.st_size, st.st_mtime_ns]
+        # the segments that are there already decide how the log is split
+        self.period = manifest['period']
+        for name, segment in manifest['segments'].items():
+            ours = self.segments.get(name)
+            if ours is None or ours['stamp'] != self._stamp(name):
+                self.segments[name] = segment
+        # a segment whose entry was lost to a concurrent save
+        for f in os.listdir(self.dir):
+            name, ext = os.path.splitext(f)
+            if ext == '.log' and name not in self.segments:
+                self._scan(name)
+
+    def _save(self):
+        self._load()  # so as not to drop what others added meanwhile
+        tmp = '{}.{}'.format(self.manifestf, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'period': self.period, 'segments': self.segments}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, self.manifestf)
+        st = os.stat(self.manifestf)
+        self._manifest_stamp = [st.st_size, st.st_mtime_ns]
+
+    @property
+    def fsync(self):
+        return self._fsync
+
+    @fsync.setter
+    def fsync(self, fsync):
+        Logger.check_fsync(fsync)
+        self._fsync = fsync
+        for logger in self._loggers.values():
+            logger.fsync = fsync
+
+    def name(self, t):
+        '''The name of the segment for unixtime t.'''
+        return time.strftime(PERIODS[self.period], time.localtime(t))
+
+    def path(self, name):
+        return os.path.join(self.dir, name + '.log')
+
+    def names(self):
+        '''The names of the segments, in chronological order.'''
+        with self._lock:
+            self._load()
+            return sorted(self.segments)
+
+    def logger(self, name):
+        if name not in self._loggers:
+            self._loggers[name] = Logger(self.path(name), self.linelen,
+                                         self._fsync, self.mirrors)
+        return self._loggers[name]
+
+    @property
+    def logf(self):
+        '''The latest segment (the one to edit).'''
+        names = self.names()
+        return self.path(names[-1] if names else self.name(time.time()))
+
+    def _stamp(self, name):
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return [0, 0]
+        return [st.st_size, st.st_mtime_ns]
+
+    def _scan(self, name):
+        '''Recounts the lines and time range of a segment.'''
+        segment = {'start': None, 'end': None, 'lines': 0,
+                   'stamp': self._stamp(name)}
+        try:
+            with open(self.path(name)) as f:
+                for line in f:
+                    t = linetime(line, None)
+                    if t is not None:
+                        segment['start'] = min(t, segment['start'] or t)
+                        segment['end'] = max(t, segment['end'] or t)
+                    segment['lines'] += 1
+        except FileNotFoundError:
+            pass
+        self.segments[name] = segment
+        return segment
+
+    def segment(self, name):
+        '''The manifest entry for a segment, rescanning it if the segment
+        changed since the manifest was written.'''
+        with self._lock:
+            segment = self.segments.get(name)
+            if segment is None or segment['stamp'] != self._stamp(name):
+                segment = self._scan(name)
+                self._save()
+            return segment
+
+    def _write(self, lines):
+        '''Appends lines to the segments their timestamps belong in.  Lines
+        without one go with the line before.'''
+        groups = {}
+        t = time.time()
+        for line in lines:
+            t = linetime(line, t)
+            groups.setdefault(self.name(t), []).append(line)
+        os.makedirs(self.dir, exist_ok=True)
+        with self._lock:
+            self._load()
+            for name, group in sorted(groups.items()):
+                segment = self.segments.get(name)
+                fresh = segment is not None and \
+                    segment['stamp'] == self._stamp(name)
+                self.logger(name).log_many(group)
+                if not fresh:
+                    self._scan(name)
+                    continue
+                times = [linetime(line, None) for line in group] + \
+                    [segment['start'], segment['end']]
+                times = [t for t in times if t is not None]
+                if times:
+                    segment['start'], segment['end'] = min(times), max(times)
+                segment['lines'] += len(group)
+                segment['stamp'] = self._stamp(name)
+            self._save()
+
+    def log(self, s):
+        '''append a string to the log'''
+        self.log_many([s])
+    slog = log
+
+    def log_many(self, lines):
+        '''append several lines to the log, with a single write per segment'''
+        lines = [line if line[-1] == '\n' else line + '\n'
+                 for line in lines if line]
+        if not lines:
+            return
+        with self._lock:
+            if self._batch is not None:
+                self._batch.extend(lines)
+                return
+        self._write(lines)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Group commit, as in Logger.batch.'''
+        with self._lock:
+            if self._batch is not None:
+                yield self
+                return
+            self._batch = []
+            try:
+                yield self
+            finally:
+                lines, self._batch = self._batch, None
+                if lines:
+                    self._write(lines)
+
+    def tail(self, n=1):
+        '''Returns the last n lines of the log, as in Logger.tail.'''
+        lines = []
+        for name in reversed(self.names()):
+            if len(lines) >= n:
+                break
+            lines = self.logger(name).tail(n - len(lines)) + lines
+        return lines
+
+    def last_line(self):
+        lines = self.tail(1)
+        return lines[0] if lines else None
+
+    def between(self, a, b):
+        '''Yields the lines of the log with timestamps in [a, b), skipping
+        the segments that can't have any.'''
+        for name in self.names():
+            segment = self.segment(name)
+            if segment['start'] is None or \
+               segment['end'] < a or segment['start'] >= b:
+                continue
+            yield from self.logger(name).between(a, b)
+
+    def lines(self):
+        '''Yields all the lines of the log, in order.'''
+        for name in self.names():
+            try:
+                with open(self.path(name)) as f:
+                    yield from f
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        for logger in self._loggers.values():
+            logger.close()
+
+
+def lines(logf):
+    '''Yields the lines of the log logf, whether it's kept in segments or
+    as a single file.'''
+    if segmented(logf):
+        yield from SegmentedLog(logf).lines()
+    else:
+        with open(logf) as f:
+            yield from f
+
+
+def import_log(logf, period='year'):
+    '''Splits the single-file log logf into segments.  logf itself is left
+    alone (you can delete it once you've checked the segments).'''
+    if segmented(logf):
+        raise ValueError('{} is already kept in segments'.format(logf))
+    log = SegmentedLog(logf, period, fsync='none')
+    with open(logf) as f:
+        log._write(list(f))
+    log.close()
+    return log
+
+
+def export_log(logf, out):
+    '''Joins the segments of the log logf up into the single file out.'''
+    with open(out, 'w') as f:
+        f.writelines(SegmentedLog(logf).lines())
+
+
+def usage():
+    print('Usage: ./segments.py import LOGFILE [year|month]\n'
+          '       ./segments.py export LOGFILE OUTFILE', file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        usage()
+    if sys.argv[1] == 'import' and len(sys.argv) in (3, 4):
+        log = import_log(sys.argv[2], *sys.argv[3:])
+        for name in log.names():
+            print('{}: {} lines'.format(log.path(name),
+                                        log.segments[name]['lines']))
+    elif sys.argv[1] == 'export' and len(sys.argv) == 4:
+        export_log(sys.argv[2], sys.argv[3])
+    else:
+        usage()
@@ -2,15 +2,25 @@
 
 from rand import ExpRand
 from logger import Logger
+from segments import SegmentedLog
+import criteria
+import tagquery
 
+import functools
+import importlib.util
+import marshal
 import os
 import shlex
-import subprocess
+import shutil
+import struct
 
 SETTINGS_FILE = '.pytagtimerc'
 SETTINGS_PATH = os.path.expanduser(os.path.join('~', SETTINGS_FILE))
 # use .pytagtimerc for now so as not to interfere with the old perl
 # config
+# The daemon tells the processes it starts which settings file to use
+# (when it's pinging for several users) through this variable.
+SETTINGS_PATH = os.environ.get('PYTAGTIMERC') or SETTINGS_PATH
 
 DEFAULTS = {
     'user': os.environ.get('USER', None),
@@ -35,6 +45,16 @@ DEFAULTS = {
 
     'linelen': 79,    # Try to keep log lines at most this long.
 
+    'fsync': 'batch', # When to fsync the log: 'none', 'batch' (after each
+    # write, which may hold several lines) or 'line' (after every line).
+
+    'segments': None, # Keep the log as one file per 'year' or 'month'
+    # instead of a single file (see segments.py).
+
+    'mirrors': False, # Update the log's index and columns (see logindex.py
+    # and columnar.py) as pings are logged, instead of
+    # rebuilding them when they're next read.
+
     'enforcenums': False,  # Whether it forces you to include a number in your
     # ping response (include tag non or nonXX where XX
     # is day of month to override).
@@ -48,18 +68,71 @@ DEFAULTS = {
     'playsound': "echo -e '\a'",
     'quiet': False,
 
+    # The terminal and editor for editing the log: a full path, or just a
+    # name to look up on the PATH (a program that isn't there is left out).
+    'xt': 'xterm',
+    'ed': 'nano',
+
     'beemauth': None,
     'beeminder': {}
 }
 
+# Compiled settings files are cached here, keyed on their mtime and size.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'pytagtime')
+CACHE_HEADER = struct.Struct('=4sqq')  # magic number, mtime_ns, size
+
+def compile_from_path(path):
+    '''Returns the code object for the given settings file, using the
+    cached compiled copy if the file hasn't changed since it was made.'''
+    st = os.stat(path)
+    stamp = (importlib.util.MAGIC_NUMBER, st.st_mtime_ns, st.st_size)
+    cachef = os.path.join(
+        CACHE_DIR, os.path.abspath(path).replace(os.sep, '%') + '.pyc')
+    try:
+        with open(cachef, 'rb') as f:
+            data = f.read()
+        if CACHE_HEADER.unpack_from(data) == stamp:
+            return marshal.loads(data[CACHE_HEADER.size:])
+    except (IOError, ValueError, EOFError, TypeError, struct.error):
+        pass
+    with open(path, 'r') as f:
+        code = compile(f.read(), path, 'exec')
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = '{}.{}'.format(cachef, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(CACHE_HEADER.pack(*stamp))
+            f.write(marshal.dumps(code))
+        os.replace(tmp, cachef)
+    except IOError:
+        pass  # it's only a cache
+    return code
+
+
 def import_from_path(path, namespace=None):
     globals = {} if namespace is None else namespace
-    with open(path, 'r') as f:
-        contents = f.read()
-    exec(contents, globals)
+    exec(compile_from_path(path), globals)
     return globals
 
 
+@functools.lru_cache(maxsize=None)
+def which(program):
+    '''Full path of the given program, or '' if it isn't on the PATH.
+    (Like `which`, but without forking a process to run it.)'''
+    return shutil.which(program) or ''
+
+
+def resolve(cmd):
+    '''A command as given in the settings: a bare program name is looked
+    up on the PATH (giving '' if it isn't there), anything else is left
+    as it is.'''
+    if cmd and os.sep not in cmd and not any(c.isspace() for c in cmd):
+        return which(cmd)
+    return cmd
+
+
 def default_property(func):
     name = func.__name__
     def attr(self):
@@ -75,13 +148,23 @@ class Settings:
         namespace = dict(DEFAULTS)
 
         path = os.path.abspath(os.path.dirname(__file__))
-        xt = subprocess.getoutput('which xterm')
-        ed = subprocess.getoutput('which nano')
-
-        namespace.update(path=path, xt=xt, ed=ed)
+        namespace.update(path=path)
+        # for beeminder criteria (see tagquery.py and criteria.py)
+        namespace.update(query=tagquery.query, timeless=criteria.timeless,
+                         per_weekday=criteria.per_weekday)
 
         return namespace
 
+    # The terminal and editor are only looked up on the PATH when they're
+    # needed, since most tagtime processes never open either.
+    @property
+    def xt(self):
+        return resolve(self._dict['xt'])
+
+    @property
+    def ed(self):
+        return shlex.split(resolve(self._dict['ed']))
+
     def get_xt_cmd(self, t, *args):
         # if 'xt_cmd' in self._dict:
         #     return shlex.split(self._dict['xt_cmd'])
@@ -116,12 +199,40 @@ class Settings:
 
     def __init__(self, srcpath=SETTINGS_PATH, defaults=DEFAULTS):
         self._srcpath = srcpath
-        self._dict = import_from_path(self._srcpath,
-                                      self.get_default_namespace())
+        self._dict = {}
+        self.rand = None
+        self.logger = None
+        self._logkey = None  # what the logger was made for
+        self.load()
 
-        self.rand = ExpRand(seed=self.seed, gap=self.gap)
-        self.logger = Logger(logf=self.logf, linelen=self.linelen)
-        self.ed = shlex.split(self._dict['ed'])
+    @property
+    def srcpath(self):
+        return self._srcpath
+
+    def load(self):
+        '''(Re)reads the settings file.  The RNG (and with it the warm ping
+        tables) is only replaced if seed or gap changed, and the logger only
+        if logf, linelen, segments or mirrors did.'''
+        new = import_from_path(self._srcpath, self.get_default_namespace())
+        Logger.check_fsync(new['fsync'])  # before anything is changed
+        old, self._dict = self._dict, new
+
+        if self.rand is None or \
+           (self.seed, self.gap) != (old.get('seed'), old.get('gap')):
+            self.rand = ExpRand(seed=self.seed, gap=self.gap,
+                                cachedir=CACHE_DIR)
+        logkey = (self.logf, self.linelen, self.segments, self.mirrors)
+        if self.logger is None or logkey != self._logkey:
+            if self.segments:
+                self.logger = SegmentedLog(self.logf, self.segments,
+                                           linelen=self.linelen,
+                                           fsync=self.fsync,
+                                           mirrors=self.mirrors)
+            else:
+                self.logger = Logger(logf=self.logf, linelen=self.linelen,
+                                     fsync=self.fsync, mirrors=self.mirrors)
+            self._logkey = logkey
+        self.logger.fsync = self.fsync
 
     def __getattr__(self, key):
         if key and key[0] != '_' and key in self._dict:
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+'''
+A small query language for picking out pings by their tags, eg:
+
+    (work or job) and not afk and weekday(mon..fri)
+    code and hour(9..17)
+
+A bare word matches pings that have that tag.  Queries combine them with
+and, or, not and parens, and can also look at when the ping was with
+weekday(...) and hour(...), which take a comma-separated list of days
+(mon, tue, ...) or hours (0-23), or ranges like mon..fri or 9..17 (both
+ends included).
+
+A query is parsed once and compiled to a tree of closures that only do
+set lookups on the ping's tags.  Queries can be used as Beeminder
+criteria in .pytagtimerc, where query() is predefined:
+
+    beeminder = {'alice/work': query('(work or job) and not afk')}
+
+or to pick pings out of a log:
+
+    $ ./tagquery.py 'work and weekday(sat, sun)' ~/tagtime/alice.log
+'''
+
+import re
+import sys
+import time
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']  # tm_wday order
+KEYWORDS = {'and', 'or', 'not'}
+TOKEN = re.compile(r'''\s*(?:
+    (?P<func>weekday|hour)\s*\((?P<args>[^()]*)\)
+  | (?P<paren>[()])
+  | (?P<word>[^\s()]+)
+)''', re.VERBOSE)
+
+
+def _values(func, args):
+    '''The set of tm_wday or tm_hour values in the arguments of weekday()
+    or hour(), eg, 'mon..wed, fri' -> {0, 1, 2, 4}.'''
+    def value(arg):
+        arg = arg.strip().lower()
+        if func == 'weekday' and arg[:3] in WEEKDAYS:
+            return WEEKDAYS.index(arg[:3])
+        if func == 'hour' and arg.isdigit() and int(arg) < 24:
+            return int(arg)
+        raise ValueError('Bad argument to {}(): {!r}'.format(func, arg))
+    values = set()
+    for arg in args.split(','):
+        if '..' in arg:
+            first, last = (value(end) for end in arg.split('..', 1))
+            n = 7 if func == 'weekday' else 24
+            values.update((first + i) % n for i in range((last - first) % n + 1))
+        else:
+            values.add(value(arg))
+    return frozenset(values)
+
+
+class Query:
+    '''A compiled query.  Call it with (tags, ts), like the lambdas in
+    settings.beeminder: tags is a string of space-separated tags (or any
+    container of tags, like a Ping's tags) and ts a time.struct_time (or a
+    unixtime).  Returns whether the ping matches.'''
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = list(TOKEN.finditer(source.rstrip()))
+        self.pos = 0
+        # what of the time it looks at: nothing, the weekday, or the weekday
+        # and hour (see criteria.py, which caches results accordingly)
+        self.tskey = 'timeless'
+        self.matcher = self._or()
+        if self.pos < len(self.tokens):
+            self._error('Unexpected')
+        del self.tokens
+
+    def _error(self, what):
+        token = self.tokens[self.pos].group().strip() \
+            if self.pos < len(self.tokens) else 'end of query'
+        raise ValueError('{} {!r} in query: {!r}'.format(what, token,
+                                                         self.source))
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos].group().strip()
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek() == 'or':
+            self.pos += 1
+            terms.append(self._and())
+        return self._combine(terms, any_=True)
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek() == 'and':
+            self.pos += 1
+            terms.append(self._not())
+        return self._combine(terms, any_=False)
+
+    def _not(self):
+        if self._peek() == 'not':
+            self.pos += 1
+            term = self._not()
+            return lambda tags, tm: not term(tags, tm)
+        return self._atom()
+
+    def _atom(self):
+        if self.pos >= len(self.tokens):
+            self._error('Expected a tag but got')
+        m = self.tokens[self.pos]
+        self.pos += 1
+        if m.group('paren') == '(':
+            term = self._or()
+            if self._peek() != ')':
+                self._error('Expected ) but got')
+            self.pos += 1
+            return term
+        if m.group('func'):
+            values = _values(m.group('func'), m.group('args'))
+            if m.group('func') == 'weekday':
+                if self.tskey == 'timeless':
+                    self.tskey = 'weekday'
+                return lambda tags, tm: tm.tm_wday in values
+            self.tskey = 'hour'
+            return lambda tags, tm: tm.tm_hour in values
+        if m.group('word') and m.group('word') not in KEYWORDS:
+            tag = m.group('word')
+            matcher = lambda tags, tm: tag in tags
+            matcher.tag = tag
+            return matcher
+        self.pos -= 1
+        self._error('Expected a tag but got')
+
+    @staticmethod
+    def _combine(terms, any_):
+        '''Combines the terms with or (any_) or and.  Runs of plain tags
+        become a single set operation.'''
+        if len(terms) == 1:
+            return terms[0]
+        tagset = frozenset(term.tag for term in terms if hasattr(term, 'tag'))
+        others = [term for term in terms if not hasattr(term, 'tag')]
+        if tagset and any_:
+            others.insert(0, lambda tags, tm: not tagset.isdisjoint(tags))
+        elif tagset:
+            others.insert(0, lambda tags, tm: all(tag in tags for tag in tagset))
+        if len(others) == 1:
+            return others[0]
+        if any_:
+            return lambda tags, tm: any(term(tags, tm) for term in others)
+        return lambda tags, tm: all(term(tags, tm) for term in others)
+
+    def __call__(self, tags, ts=None):
+        if isinstance(tags, str):
+            tags = set(tags.split())
+        if self.tskey != 'timeless' and not isinstance(ts, time.struct_time):
+            ts = time.localtime(ts)
+        return self.matcher(tags, ts)
+
+    def __repr__(self):
+        return 'query({!r})'.format(self.source)
+
+
+def query(source):
+    '''Parses and compiles a query.  Raises ValueError if it's malformed.'''
+    return Query(source)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: ./tagquery.py QUERY LOGFILE', file=sys.stderr)
+        sys.exit(1)
+    from logparse import scan
+    import segments
+    q = query(sys.argv[1])
+    for line in segments.lines(sys.argv[2]):
+        scanned = scan(line)
+        if scanned is not None and q(scanned[1], scanned[0]):
+            sys.stdout.write(line)
@@ -2,12 +2,13 @@
 '''
 TagTime daemon: this figures out from scratch when to beep and does so,
 continuously, even when the previous ping is still unanswered.
-After each ping it also runs launch.pl (with the 'quiet' arg since
-this is already doing the beeping) which launches popups or an editor
-for any overdue pings.
-Might be nice to watch ~/.tagtimerc (aka settings.pl) for changes a la
-watching.pl so that we don't have to restart this daemon when settings
-change. (does it suffice to just re-require it?)
+After each ping it also runs the launch.py logic (in a thread) which
+launches popups or an editor for any overdue pings.
+It watches ~/.pytagtimerc and reloads it when it changes, so there's no
+need to restart this daemon when settings change.  The ping schedule is
+only recomputed if the seed or gap changed.
+Given one or more settings files as arguments, it pings for all of those
+users from this one process instead (see scheduler.py).
 '''
 #
 #=head1 NAME
@@ -65,86 +66,154 @@ change. (does it suffice to just re-require it?)
 #}
 
 import datetime
-import os
-import shlex
-import subprocess
 import sys
+import threading
 import time
-try:
-    import pause
-except ImportError:
-    pause = None
 
-def wait(nextping):
-    '''Sleep till the next ping.
+import timer
+import watch
 
-    If available, we will use the pause library to get better precision,
-    otherwise we'll wait just a few seconds in case the machine is suspended.
-    '''
-    if pause:
-        pause.until(nextping)
-    else:
-        time.sleep(util.clip(nextping - time.time(), 0, 2))
-
-from settings import settings
-
-launchtime = time.time()
-
-import util
-
-rand = settings.rand
-
-lstping = rand.prevping(launchtime)
-nxtping = rand.nextping(lstping)
-
-if settings.cygwin:
-    util.unlock()  # on cygwin may have stray lock files around.
+waker = timer.timer()
 
-# Catch up on any old pings.
-cmd = os.path.join(settings.path, 'launch.py')
-if subprocess.call(cmd) != 0:
-    print('SYSERR:', cmd, file=sys.stderr)
+def wait(nextping, fds=()):
+    '''Sleep till the next ping, or till one of fds is readable.
 
-tdelta = datetime.timedelta(seconds=time.time()-lstping)
-print("TagTime is watching you! Last ping would've been",
-      tdelta, "ago.", file=sys.stderr)
-
-start = time.time()
-i = 1
-
-while True:
-    # sleep till next ping but check again in at most a few seconds in
-    # case computer was off (should be event-based and check upon wake).
-    wait(nxtping)
-
-    # time.sleep(util.clip(nextping - time.time(), 0, 2))
-    now = time.time()
-
-    if nxtping <= now:
-        if settings.catchup or nxtping > now - settings.retrothresh:
-	        util.playsound()
-
-        # invokes popup for this ping plus additional popups if there were more
-        #   pings while answering this one:
-        cmd = [os.path.join(settings.path, 'launch.py'), 'quiet', '&'];
-        util.callcmd(cmd)
-        s = '{i: 4}: PING! gap {gap} avg {avg} tot {tot}'.format(
-            i=i,
-            gap=datetime.timedelta(seconds=nxtping-lstping),
-            avg=datetime.timedelta(seconds=(0.0 + time.time() - start) / i),
-            tot=datetime.timedelta(seconds=(0.0 + time.time() - start)))
-        print(util.annotime(s, nxtping, 72), file=sys.stderr)
-
-        lstping = nxtping
-        nxtping = rand.nextping(nxtping)
-        i += 1
+    Where possible this is a single timer for the time of the next ping,
+    which also goes off on resume from suspend and when the clock is set
+    (see timer.py); otherwise we wait just a few seconds at a time in case
+    the machine is suspended.
+    '''
+    return waker.wait(nextping, fds)
 
+from settings import settings, Settings
 
-## Invoke popup for this ping plus additional popups if there were more pings
-## while answering this one.
-def pingery():
-    # TODO: move everything from launch.py to here
-    return 0
+import util
+import launch
+import scheduler
+
+# Invoke popup for this ping plus additional popups if there were more pings
+# while answering this one.  This runs the launch logic in a thread of this
+# process, so the daemon keeps pinging while a popup is waiting for an answer;
+# only the popup itself (and the editor) are child processes.
+launching = {}  # settings file -> lock held while launch.run runs for it
+
+def pingery(user=settings):
+    lock = launching.setdefault(user.srcpath, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return  # the running launcher will get to this ping too
+    def run():
+        while True:
+            try:
+                launch.run(settings=user)
+            finally:
+                lock.release()
+            # a ping that came due after launch.run last checked, but before
+            # the lock was released, was turned away above: get to it now
+            if not launch.due(user) or not lock.acquire(blocking=False):
+                return
+    threading.Thread(target=run, daemon=True).start()
+
+
+def reload():
+    '''Pick up changes to the settings file.  Returns whether the ping
+    schedule (seed or gap) changed.'''
+    rand = settings.rand
+    try:
+        settings.load()
+    except Exception as e:  # eg, a syntax error while it's being edited
+        print('Error reloading {}, keeping the old settings: {}'.format(
+            settings.srcpath, e), file=sys.stderr)
+        return False
+    print('Reloaded', settings.srcpath, file=sys.stderr)
+    return settings.rand is not rand
+
+
+def main():
+    launchtime = time.time()
+
+    rand = settings.rand
+    watcher = watch.watcher(settings.srcpath)
+
+    lstping = rand.prevping(launchtime)
+    nxtping = rand.nextping(lstping)
+
+    if settings.cygwin:
+        util.unlock()  # on cygwin may have stray lock files around.
+
+    # Catch up on any old pings.
+    with launching.setdefault(settings.srcpath, threading.Lock()):
+        launch.run()
+
+    tdelta = datetime.timedelta(seconds=time.time()-lstping)
+    print("TagTime is watching you! Last ping would've been",
+          tdelta, "ago.", file=sys.stderr)
+
+    start = time.time()
+    i = 1
+
+    while True:
+        # sleep till next ping (or till the clock changes under us, in which
+        # case we just check again).
+        wait(nxtping, watcher.fds())
+
+        now = time.time()
+
+        if watcher.changed() and reload():
+            rand = settings.rand
+            lstping = rand.prevping(now)
+            nxtping = rand.nextping(lstping)
+            continue
+
+        if nxtping <= now:
+            if settings.catchup or nxtping > now - settings.retrothresh:
+                util.playsound()
+
+            # invokes popup for this ping plus additional popups if there were more
+            #   pings while answering this one:
+            pingery()
+            s = '{i: 4}: PING! gap {gap} avg {avg} tot {tot}'.format(
+                i=i,
+                gap=datetime.timedelta(seconds=nxtping-lstping),
+                avg=datetime.timedelta(seconds=(0.0 + time.time() - start) / i),
+                tot=datetime.timedelta(seconds=(0.0 + time.time() - start)))
+            print(util.annotime(s, nxtping, 72), file=sys.stderr)
+
+            lstping = nxtping
+            nxtping = rand.nextping(nxtping)
+            i += 1
+
+
+def multi(paths):
+    '''Ping for several users from this one process, given each user's
+    settings file.  Users on the same seed and gap share one schedule
+    (see scheduler.py).'''
+    launchtime = time.time()
+    pinger = scheduler.Scheduler()
+    for path in paths:
+        user = Settings(path)
+        pinger.add(user, after=launchtime)
+        pingery(user)  # catch up on any old pings.
+    print("TagTime is watching {} users on {} schedules!".format(
+        len(paths), len(pinger.schedules)), file=sys.stderr)
+
+    while True:
+        wait(pinger.nextping())
+        now = time.time()
+        while pinger.nextping() <= now:
+            nxtping, users = pinger.pop()
+            for user in users:
+                if user.catchup or nxtping > now - user.retrothresh:
+                    util.playsound(user)
+                pingery(user)
+            s = 'PING! for {}'.format(' '.join(str(user.user) for user in users))
+            print(util.annotime(s, nxtping, 72), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:  # tagtimed.py ~alice/.pytagtimerc ~bob/.pytagtimerc
+        multi(sys.argv[1:])
+    else:
+        main()
 
 
 #
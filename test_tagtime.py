@@ -1,5 +1,785 @@
+import collections
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import pytest
+
+import beemapi
+import columnar
+import criteria
+import logger
+import logparse
+import rand
+import scheduler
+import segments
+import tagquery
+import timer
+import watch
+
+
+def naive_prevping(r, t):
+    '''The original walk from the birth of tagtime, for comparison.'''
+    r.seed = r.initseed
+    nxtping = lstping = rand.BIRTH
+    lstseed = r.seed
+    while nxtping < t:
+        lstping = nxtping
+        lstseed = r.seed
+        nxtping = r.nextping(nxtping)
+    r.seed = lstseed
+    return lstping
+
+
+def regex_strip(s):
+    '''The original (quadratic) strip, for comparison.'''
+    while True:
+        s, n = re.subn(r'\([^\(\)]*\)', '', s)
+        if n == 0:
+            break
+    while True:
+        s, n = re.subn(r'\[[^\[\]]*\]', '', s)
+        if n == 0:
+            break
+    return s
+
+
+def regex_stripb(s):
+    return re.sub(r'\s*\[[^\[\]]*\]', '', s)
+
+
+def loop_stripc(s):
+    '''The original stripc, for comparison.'''
+    pairs = {'(': ')', '[': ']'}
+    reverse_pairs = {val: key for (key, val) in pairs.items()}
+    result = []
+    openers = []
+    for i, c in enumerate(s):
+        if c in pairs:
+            openers.append(i)
+        elif c in reverse_pairs:
+            if openers and s[openers[-1]] == reverse_pairs[c]:
+                start = openers.pop()
+                if not openers:
+                    result.append(s[start:i+1])
+    return ''.join(result)
+
+
+def tagmatch(tags, crit, ts):
+    '''beeminder.tagmatch (which needs the settings), for comparison.'''
+    if isinstance(crit, tagquery.Query):
+        return crit(tags, ts)
+    if isinstance(crit, str):
+        return re.search(r'\b{crit}\b'.format(crit=crit), tags)
+    if isinstance(crit, list):
+        return any(re.search(r'\b{c}\b'.format(c=c), tags) for c in crit)
+    if callable(crit):
+        return crit(tags, ts)
+    return crit.search(tags)
 
 
 class TestTagTime:
     def test_tagtime(self):
         pass
+
+
+class TestLogParse:
+    def test_ping(self):
+        a = logparse.Ping.parse('1234 foo bar (a comment) [2017.05.01]\n')
+        b = logparse.Ping.parse('  1300   foo  bar')
+        assert (a.time, a.tags, a.comment) == \
+            (1234, ('foo', 'bar'), '(a comment)[2017.05.01]')
+        assert b.tags is a.tags  # interned
+        assert len({a, logparse.Ping.parse(' 1234 foo bar (a comment)[2017.05.01]'),
+                    b}) == 2
+        assert logparse.Ping.parse('1400 [only a comment]').tags == ()
+        assert logparse.Ping.parse('no timestamp') is None
+        assert [p.time for p in logparse.pings(['1 a', 'x', '2 b'])] == [1, 2]
+
+    def test_strip(self):
+        rng = random.Random(19)
+        for _ in range(5000):
+            s = ''.join(rng.choice('ab ()[]\t') for _ in range(rng.randint(0, 20)))
+            assert logparse.strip(s) == regex_strip(s), s
+            assert logparse.stripb(s) == regex_stripb(s), s
+            assert logparse.stripc(s) == loop_stripc(s), s
+            t, tags, comments, unmatched = logparse.scan('123 ' + s)
+            assert (t, tags, comments) == \
+                (123, regex_strip(s).split(), loop_stripc(s))
+            assert unmatched == bool(re.search(r'[()\[\]]', regex_strip(s)))
+        assert list(logparse.scan_lines(['1 a (b', 'x'])) == \
+            [(1, ['a', '(b'], '', True), None]
+        # deep nesting is no problem
+        s = '1 a ' + '(' * 10000 + 'x' + ')' * 10000 + ' b' + ' ' * 10000 + '[c]'
+        assert logparse.scan(s) == (1, ['a', 'b'], s[4:20005] + '[c]', False)
+        assert logparse.stripb(s) == s[:-10003]
+
+
+class TestExpRand:
+    times = [0, rand.BIRTH, rand.BIRTH + 1, rand.BIRTH + 86400 * 30,
+             rand.BIRTH + 86400 * 400, rand.BIRTH + 86400 * 90]
+
+    def test_prevping_checkpoints(self, tmp_path):
+        r = rand.ExpRand(seed=666, gap=45*60, cachedir=str(tmp_path))
+        r.CHECKPOINT_EVERY = 50
+        r._table = False  # test the walk, not the ping table
+        ref = rand.ExpRand(seed=666, gap=45*60)
+        for t in self.times:
+            assert r.prevping(t) == naive_prevping(ref, t)
+            assert r.seed == ref.seed
+            assert r.nextping(t) == ref.nextping(t)
+
+        # a fresh instance picks up the saved table
+        r2 = rand.ExpRand(seed=666, gap=45*60, cachedir=str(tmp_path))
+        r2.CHECKPOINT_EVERY = 50
+        r2._table = False
+        assert len(r2._load_checkpoints()) == len(r._checkpoints)
+        for t in reversed(self.times):
+            assert r2.prevping(t) == naive_prevping(ref, t)
+            assert r2.seed == ref.seed
+
+    def test_ping_table(self, tmp_path):
+        r = rand.ExpRand(seed=666, gap=45*60, cachedir=str(tmp_path))
+        ref = rand.ExpRand(seed=666, gap=45*60)
+        for t in self.times + [rand.TABLE_END + 86400]:
+            assert r.prevping(t) == naive_prevping(ref, t)
+            assert r.seed == ref.seed
+        start = rand.BIRTH + 86400 * 20
+        assert list(r.schedule(start, start + 86400 * 10)) == \
+            list(ref.schedule(start, start + 86400 * 10))
+
+        # a table for another seed is regenerated
+        with open(r.tablef(), 'rb') as f:
+            data = f.read()
+        r3 = rand.ExpRand(seed=667, gap=45*60, cachedir=str(tmp_path))
+        with open(r3.tablef(), 'wb') as f:
+            f.write(data)
+        ref3 = rand.ExpRand(seed=667, gap=45*60)
+        t = self.times[-1]
+        assert r3.prevping(t) == naive_prevping(ref3, t)
+        assert r3.table().seed == 667
+
+    def test_schedule(self):
+        for gap in [45*60, 30]:
+            r = rand.ExpRand(seed=666, gap=gap)
+            start = rand.BIRTH + 86400
+            end = start + 86400 * 20
+            pings = []
+            ping = r.nextping(r.prevping(start))
+            while ping < end:
+                pings.append(ping)
+                ping = r.nextping(ping)
+            assert [int(p) for p in r.schedule(start, end)] == pings
+
+    def test_iter_pings(self):
+        r = rand.ExpRand(seed=666, gap=45*60)
+        t = rand.BIRTH + 86400 * 3
+        ping = r.prevping(t)
+        expected = []
+        for i in range(20):
+            ping = r.nextping(ping)
+            expected.append((ping, r.seed))
+        seed = r.seed
+
+        results = []
+        def reader():
+            results.append(list(itertools.islice(r.iter_pings(after=t), 20)))
+        threads = [threading.Thread(target=reader) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [expected] * 4
+        assert r.seed == seed  # untouched by the cursors
+        # a cursor started right at a ping excludes it
+        after = list(itertools.islice(r.iter_pings(after=expected[0][0]), 19))
+        assert after == expected[1:]
+        assert next(r.iter_pings(after=0)) == (rand.BIRTH, r.initseed)
+
+
+class TestRandom:
+    def test_skip(self):
+        r1 = rand.Random(666)
+        r2 = rand.Random(666)
+        for k in [0, 1, 2, 17, 1000]:
+            for i in range(k):
+                r1.ran0()
+            assert r2.skip(k) == r1.seed
+        assert r2.seed_at(1020) == r1.seed
+
+    def test_ranx(self):
+        r1 = rand.Random(42)
+        r2 = rand.Random(42)
+        assert r2.ranx(0) == r1.seed / r1.IM
+        for i in range(37):
+            x = r1.ran01()
+        assert r2.ranx(37) == x
+
+
+class TestLogger:
+    def test_tail(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        log = logger.Logger(logf)
+        log.BLOCKSIZE = 5
+        assert log.last_line() is None
+        for content in ['', 'a', 'a\n', '1 foo\n2 bar baz\n3 qux\n',
+                        '1 foo\n2 bar baz\n3 qux', 'x\n\n']:
+            with open(logf, 'w') as f:
+                f.write(content)
+            lines = content.splitlines(True)
+            for n in [1, 2, 10]:
+                assert log.tail(n) == lines[-n:]
+            assert log.last_line() == (lines[-1] if lines else None)
+
+    def test_log_many(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        log = logger.Logger(logf)
+        log.log('1 foo')
+        log.log_many(['2 bar\n', '', '3 baz'])
+        log.log_many([])
+        with open(logf) as f:
+            assert f.read() == '1 foo\n2 bar\n3 baz\n'
+
+    def test_batch(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        log = logger.Logger(logf, fsync='none')
+        with log.batch():
+            log.log('1 foo')
+            log.log_many(['2 bar', '3 baz'])
+            assert not os.path.exists(logf)
+        with open(logf) as f:
+            assert f.read() == '1 foo\n2 bar\n3 baz\n'
+
+        # the log is reopened if an editor replaces it
+        tmp = str(tmp_path / 'user.log.new')
+        with open(tmp, 'w') as f:
+            f.write('1 edited\n')
+        os.replace(tmp, logf)
+        log.log('4 qux')
+        with open(logf) as f:
+            assert f.read() == '1 edited\n4 qux\n'
+
+        with pytest.raises(ValueError):
+            log.fsync = 'bacth'
+        assert log.fsync == 'none'
+
+    def test_concurrent_appends(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        lines = ['{} {}'.format(i, 'x' * 500) for i in range(200)]
+        def append(lines):
+            log = logger.Logger(logf, fsync='none')
+            for line in lines:
+                log.log(line)
+        threads = [threading.Thread(target=append, args=(lines[i::4],))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(logf) as f:
+            assert sorted(f.read().splitlines()) == sorted(lines)
+
+    def test_between(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        log = logger.Logger(logf, fsync='none', mirrors=True)
+        log.index.every = 4
+        lines = ['{} tag{}\n'.format(1000 + 10 * i, i) for i in range(50)]
+        with open(logf, 'w') as f:
+            f.writelines(lines[:20])
+        assert list(log.between(1000, 1050)) == lines[:5]
+        log.log_many(lines[20:30])
+        for line in lines[30:]:
+            log.log(line)
+        assert log.index.nlines == 50  # kept up to date, not rebuilt
+        for a, b in [(0, 10**9), (1055, 1100), (1100, 1101), (1490, 1500),
+                     (1200, 1200), (2000, 3000)]:
+            assert list(log.between(a, b)) == \
+                [line for line in lines if a <= int(line.split()[0]) < b]
+
+        # an edit is noticed and the index rebuilt
+        with open(logf, 'w') as f:
+            f.writelines(lines[::2])
+        assert list(log.between(1000, 1100)) == lines[:10:2]
+        fresh = logger.Logger(logf)
+        fresh.index.every = 4
+        assert list(fresh.between(1300, 1400)) == lines[30:40:2]
+        fresh.log('1500 tag50')  # without mirrors, only the log is written
+        assert fresh.index.nlines == 25
+        assert list(fresh.between(1490, 2000)) == ['1500 tag50\n']
+
+        # so is an edit in place that doesn't change the size, even when
+        # an append follows it
+        with open(logf, 'r+') as f:
+            f.write('1001')
+        st = os.stat(logf)
+        os.utime(logf, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        log.log('2000 late')
+        assert list(log.between(1000, 1010)) == ['1001 tag0\n']
+        assert log.index.times[0] == 1001
+
+    def test_columns(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        lines = ['{} {} (a comment) [annotation]\n'.format(
+            1000 + 100 * i, ' '.join(['a', 'b', 'c', 'd'][:i % 4]))
+            for i in range(40)]
+        with open(logf, 'w') as f:
+            f.writelines(lines[:10])
+        log = logger.Logger(logf, fsync='none', mirrors=True)
+        log.log('1 not whole lines')  # the mirror doesn't exist yet
+        with open(logf, 'w') as f:
+            f.writelines(lines[:10])
+
+        def check(columns, lines):
+            times, tagptr, tagids = columns.arrays()
+            assert list(times) == [int(line.split()[0]) for line in lines]
+            assert [[columns.tags[i] for i in tagids[tagptr[j]:tagptr[j + 1]]]
+                    for j in range(len(lines))] == \
+                [line.split('(')[0].split()[1:] for line in lines]
+
+        check(log.columns, lines[:10])  # built from scratch
+        log.log_many(lines[10:30])
+        for line in lines[30:]:
+            log.log(line)
+        assert log.columns.npings == 40  # kept up to date, not rebuilt
+        check(columnar.Columns(logf), lines)
+        counts = log.columns.tally([1000, 2000, 3000, 5000])
+        a = log.columns.tagid['a']
+        assert list(counts[:, a]) == [7, 8, 15]
+        assert counts.sum() == sum(i % 4 for i in range(40))
+
+        # an edit in place that doesn't change the size isn't mistaken for
+        # part of the append that follows it
+        with open(logf, 'r+') as f:
+            f.write('1001')
+        st = os.stat(logf)
+        os.utime(logf, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        log.log(lines[-1])
+        check(log.columns, ['1001' + lines[0][4:]] + lines[1:] + lines[-1:])
+
+
+class TestSegments:
+    def test_segments(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        year = 365 * 86400
+        t0 = int(time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, -1)))
+        lines = ['{} tag{}\n'.format(t0 + i * year // 10, i) for i in range(30)]
+        with open(logf, 'w') as f:
+            f.writelines(lines[:20])
+        log = segments.import_log(logf, 'year')
+        assert log.names() == ['2015', '2016']
+        assert log.segments['2015']['lines'] == 10
+
+        log = segments.SegmentedLog(logf, 'month')  # it's split by year
+        log.log_many(lines[20:25])
+        with log.batch():
+            for line in lines[25:]:
+                log.log(line)
+        assert log.names() == ['2015', '2016', '2017']
+        assert log.logf == log.path('2017')
+        assert log.tail(3) == lines[27:]
+        assert list(segments.lines(logf)) == lines
+        a, b = t0 + year, t0 + 2 * year + 1
+        assert list(log.between(a, b)) == lines[10:21]
+
+        # an edited segment is rescanned
+        with open(log.path('2016'), 'w') as f:
+            f.writelines(lines[10:12])
+        assert list(log.between(a, b)) == lines[10:12]  # 20 was in 2016 too
+        assert segments.SegmentedLog(logf).segment('2016')['lines'] == 2
+
+        out = str(tmp_path / 'all.log')
+        segments.export_log(logf, out)
+        with open(out) as f:
+            assert f.readlines() == lines[:12] + lines[21:]
+
+    def test_two_writers(self, tmp_path):
+        logf = str(tmp_path / 'user.log')
+        t0 = int(time.mktime((2015, 6, 1, 0, 0, 0, 0, 0, -1)))
+        lines = ['{} tag{}\n'.format(t0 + i * 365 * 86400, i) for i in range(3)]
+        a = segments.SegmentedLog(logf)
+        b = segments.SegmentedLog(logf)
+        a.log(lines[0])
+        b.log(lines[1])  # a new segment a has never seen
+        assert a.names() == ['2015', '2016']
+        assert a.tail(2) == lines[:2]
+        a.log(lines[2])  # and saving the manifest keeps b's segment
+        manifest = segments.SegmentedLog(logf).segments
+        assert sorted(manifest) == ['2015', '2016', '2017']
+        assert [manifest[name]['lines'] for name in sorted(manifest)] == \
+            [1, 1, 1]
+        assert b.tail(3) == lines
+
+
+class TestTagQuery:
+    def test_query(self):
+        q = tagquery.query('(work or job) and not afk and weekday(mon..fri)')
+        monday = time.strptime('2017-07-10 10:00', '%Y-%m-%d %H:%M')
+        sunday = time.strptime('2017-07-16 10:00', '%Y-%m-%d %H:%M')
+        assert q('job email', monday)
+        assert q(('work',), monday)
+        assert not q('work afk', monday)
+        assert not q('working', monday)
+        assert not q('work', sunday)
+        assert q('work', time.mktime(monday))
+        q = tagquery.query('a and b or not c and hour(22..2, 12)')
+        assert q('a b', monday) and not q('a', monday)
+        assert q('x', time.strptime('2017-07-10 01:30', '%Y-%m-%d %H:%M'))
+        assert not q('x', monday)
+        for bad in ['', 'a and', '(a', 'a b', 'not', 'hour(25)', 'a or )']:
+            with pytest.raises(ValueError):
+                tagquery.query(bad)
+
+
+class TestCriteria:
+    def test_goal_matcher(self):
+        goals = {
+            'a/job': 'job',
+            'a/eat': r'eat\d',
+            'a/fun': ['fun', 'game', 'play.*'],
+            'a/any': [],
+            'a/re': re.compile(r'beat\d+\b'),
+            'a/ci': re.compile(r'JOB', re.I),
+            'a/grp': re.compile(r'(\w)\1'),
+            'a/q': tagquery.query('job and not afk and weekday(mon)'),
+            'a/nafk': lambda tags, ts: not re.search(r'\bafk\b', tags),
+        }
+        matcher = criteria.GoalMatcher(goals)
+        assert matcher.index == {'job': ['a/job'], 'fun': ['a/fun'],
+                                 'game': ['a/fun']}
+        rng = random.Random(23)
+        words = ['job', 'jobs', 'eat1', 'eat', 'beat12', 'fun', 'game',
+                 'playing', 'afk', 'JOB', 'oo', 'x-job', 'job:', '']
+        for _ in range(3000):
+            tags = ' '.join(rng.choice(words) for _ in range(rng.randint(0, 4)))
+            ts = time.localtime(rng.randint(0, 2 * 10**9))
+            assert matcher.match(tags, ts) == \
+                {goal for goal, crit in goals.items()
+                 if tagmatch(tags, crit, ts)}, tags
+        with pytest.raises(ValueError):
+            criteria.GoalMatcher({'a/b': 42})
+
+    def test_cache(self):
+        calls = []
+
+        def counted(tags, ts):
+            calls.append(tags)
+            return 'job' in tags.split()
+        goals = {
+            'a/job': criteria.timeless(counted),
+            'a/tue': criteria.per_weekday(lambda tags, ts: ts.tm_wday == 1),
+            'a/q': tagquery.query('fun and weekday(sat, sun)'),
+            'a/odd': lambda tags, ts: ts.tm_sec % 2 == 1,
+        }
+        matcher = criteria.GoalMatcher(goals, cache_size=64)
+        assert [goal for goal, _ in matcher.uncached] == ['a/odd']
+        rng = random.Random(24)
+        words = ['job', 'fun', 'afk', 'x']
+        for _ in range(3000):
+            tags = ' '.join(rng.sample(words, rng.randint(0, 2)))
+            ts = time.localtime(rng.randint(0, 2 * 10**9))
+            assert matcher.match(tags, ts) == \
+                {goal for goal, crit in goals.items() if crit(tags, ts)}
+        assert len(matcher.cache) == 64
+        assert matcher.hits > matcher.misses
+        assert len(calls) == 3000 + matcher.misses
+
+
+class TestBeeminder:
+    '''beeminder.py against a beemapi.BeeminderMock per Beeminder user.'''
+
+    class Mock(beemapi.BeeminderMock):
+        '''Records the requests, and fails those fail(path, request_type)
+        says should.'''
+        def __init__(self, mockdata, fail=None):
+            super().__init__(mockdata)
+            self.requests = []
+            self.chunks = []  # number of datapoints sent to each create_all
+            self.fail = fail
+
+        def execute(self, path, params=None, request_type='get'):
+            self.requests.append((path.rsplit('/', 1)[-1], request_type))
+            if path.endswith('create_all.json'):
+                self.chunks.append(len(json.loads(params['datapoints'])))
+            if self.fail is not None and self.fail(path, request_type):
+                raise ConnectionError('No connection for ' + path)
+            return super().execute(path, params, request_type)
+
+    @pytest.fixture
+    def bee(self, tmp_path, monkeypatch, capsys):
+        '''Returns a function that runs beeminder.py, with the given
+        beeminder dict (as source) in .pytagtimerc, on the given arguments.'''
+        rc = str(tmp_path / 'rc')
+        with open(rc, 'w') as f:
+            f.write('path = {!r}\nuser = "u"\nbeemauth = "x"\n'.format(
+                str(tmp_path)))
+        monkeypatch.setenv('PYTAGTIMERC', rc)
+        import settings  # the first time, this reads PYTAGTIMERC
+        monkeypatch.setattr(settings, 'CACHE_DIR', str(tmp_path / 'cache'))
+        monkeypatch.setattr(settings.settings, '_srcpath', rc)
+        self.logf = str(tmp_path / 'u.log')
+        self.servers = {}  # user -> datapoints on their mock
+        self.mocks = {}    # user -> their mock, as of the last run
+        self.fail = {}     # user -> the fail function for their mock
+        connect = beemapi.Beeminder
+
+        def beeminder(auth, usr):
+            beem = connect(auth, usr)
+            beem.backend = self.mocks[usr] = self.Mock(
+                self.servers.setdefault(usr, []), self.fail.get(usr))
+            return beem
+        monkeypatch.setattr(beemapi, 'Beeminder', beeminder)
+
+        def run(goals, *args):
+            with open(rc, 'a') as f:
+                f.write('beeminder = {}\n'.format(goals))
+            settings.settings.load()
+            monkeypatch.setattr(sys, 'argv', ['beeminder.py'] + list(args))
+            import beeminder
+            return beeminder.main()
+        return run
+
+    @staticmethod
+    def lines(ndays):
+        '''Three pings a day, at 9, 10 and 11.'''
+        t0 = int(time.mktime((2017, 7, 10, 9, 0, 0, 0, 0, -1)))
+        return ['{} {} (c{})\n'.format(
+            t0 + 86400 * (i // 3) + 3600 * (i % 3),
+            ['work', 'play', 'work fun'][i % 3], i) for i in range(3 * ndays)]
+
+    @staticmethod
+    def tally(lines, tag):
+        '''The number of pings with the tag on each day.'''
+        return collections.Counter(
+            time.strftime('%Y-%m-%d', time.localtime(int(line.split()[0])))
+            for line in lines if tag in logparse.Ping.parse(line).tags)
+
+    def days(self, usr):
+        '''The number of pings on each day on the user's mock.'''
+        return collections.Counter({
+            time.strftime('%Y-%m-%d', time.localtime(point['timestamp'])):
+            int(point['comment'].split()[0]) for point in self.servers[usr]})
+
+    def test_incremental(self, bee, monkeypatch):
+        import beeminder
+        tallied = []
+        tally = beeminder.Goal.tally
+        monkeypatch.setattr(beeminder.Goal, 'tally',
+                            lambda goal, t, *args: tallied.append(t) or
+                            tally(goal, t, *args))
+        lines = self.lines(10)
+        work = [int(line.split()[0]) for line in lines if 'work' in line]
+        with open(self.logf, 'w') as f:
+            f.writelines(lines[:15])
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert tallied == work[:10]
+        assert self.days('u') == self.tally(lines[:15], 'work')
+
+        # only the appended lines are read, and only their days sent
+        tallied.clear()
+        with open(self.logf, 'a') as f:
+            f.writelines(lines[15:])
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert tallied == work[10:]
+        assert self.mocks['u'].requests == [('create_all.json', 'post')]
+        assert self.days('u') == self.tally(lines, 'work')
+
+        # after an edit before where the last sync stopped, all of it is
+        lines[0] = lines[0].replace('work', 'play')
+        with open(self.logf, 'r+') as f:
+            f.writelines(lines)
+        tallied.clear()
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert tallied == work[1:]
+        assert self.days('u') == self.tally(lines, 'work')
+
+        # however far back the edit is, and even if it's made in place
+        padded = [line.replace('\n', ' [{}]\n'.format('.' * 5000))
+                  for line in lines]
+        with open(self.logf, 'w') as f:
+            f.writelines(padded)
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        padded[14] = padded[14].replace('work', 'play')  # 70KB in, of 150
+        with open(self.logf, 'r+') as f:
+            f.writelines(padded)
+        tallied.clear()
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert len(tallied) == len(work) - 2
+        assert self.days('u') == self.tally(padded, 'work')
+
+    def test_all(self, bee, monkeypatch):
+        import beeminder
+        scans = []
+        scan = beeminder.scan
+        monkeypatch.setattr(beeminder, 'scan', lambda ttlf, goals: scans.append(
+            ['{}/{}'.format(goal.usr, goal.slug) for goal in goals]) or
+            scan(ttlf, goals))
+        goals = "{'a/work': 'work', 'b/fun': query('fun'), 'c/play': ['play']}"
+        lines = self.lines(10)
+        with open(self.logf, 'w') as f:
+            f.writelines(lines[:12])
+        # a/work is synced on its own first, so it resumes from further on
+        assert bee(goals, self.logf, 'a/work') == 0
+        with open(self.logf, 'a') as f:
+            f.writelines(lines[12:])
+        self.fail['c'] = lambda path, request_type: True  # c is unreachable
+        scans.clear()
+        assert bee(goals, '--all', self.logf) == 1
+        assert scans == [['a/work', 'b/fun']]  # one scan for both
+        assert self.mocks['a'].requests == [('create_all.json', 'post')]
+        for usr, tag in [('a', 'work'), ('b', 'fun')]:
+            assert self.days(usr) == self.tally(lines, tag)
+        assert not os.path.exists(os.path.join(os.path.dirname(self.logf),
+                                               'c+play.bee'))
+
+        # once c can be reached again, it catches up
+        del self.fail['c']
+        assert bee(goals, '--all', self.logf) == 0
+        assert self.days('c') == self.tally(lines, 'play')
+        assert self.mocks['a'].requests == self.mocks['b'].requests == []
+
+    def test_create_all(self, bee, monkeypatch):
+        import beeminder
+        monkeypatch.setattr(beeminder.Goal, 'CREATE_CHUNK', 4)
+        lines = self.lines(10)
+        with open(self.logf, 'w') as f:
+            f.writelines(lines)
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert self.mocks['u'].chunks == [4, 4, 2]
+        assert self.days('u') == self.tally(lines, 'work')
+
+        # the goal is reset on beeminder, and the cache deleted, but the
+        # backfill fails part way through
+        del self.servers['u'][:]
+        os.remove(os.path.join(os.path.dirname(self.logf), 'u+work.bee'))
+        self.fail['u'] = lambda path, request_type: \
+            path.endswith('create_all.json') and \
+            len(self.mocks['u'].chunks) > 2
+        with pytest.raises(ConnectionError):
+            bee("{'u/work': 'work'}", self.logf, 'u/work')
+        assert len(self.servers['u']) == 8
+        del self.fail['u']
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert self.mocks['u'].chunks == [2]  # it carried on
+        assert self.days('u') == self.tally(lines, 'work')
+        assert len(self.servers['u']) == 10
+
+    def test_created(self, bee):
+        import beeminder
+        days = ['2017-07-10', '2017-07-11', '2017-07-12']
+        points = [{'id': 'c', 'requestid': days[2]},
+                  {'id': 'a', 'requestid': days[0]}]
+        got = []
+        with pytest.raises(ValueError):
+            for pair in beeminder.created(days, points):
+                got.append(pair)
+        assert got == [(days[0], points[1]), (days[2], points[0])]
+        points = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]  # no requestids
+        assert [point['id'] for day, point in beeminder.created(days, points)] \
+            == ['a', 'b', 'c']
+        with pytest.raises(ValueError):
+            list(beeminder.created(days, {'errors': 'oops'}))
+
+    def test_batches(self, bee, monkeypatch):
+        import beeminder
+        monkeypatch.setattr(beeminder.Goal, 'BATCH', 2)
+        lines = self.lines(10)
+        with open(self.logf, 'w') as f:
+            f.writelines(lines)
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        writes = []
+        write_cache = beeminder.Goal.write_cache
+        monkeypatch.setattr(beeminder.Goal, 'write_cache',
+                            lambda goal, points: writes.append(len(points)) or
+                            write_cache(goal, points))
+        for i in range(5):  # new comments on the first 5 days
+            lines[3 * i] = lines[3 * i].replace('(c', '(x')
+        for i in range(24, 30):  # and no work on the last 2
+            lines[i] = re.sub(r' \S+ ', ' play ', lines[i])
+        with open(self.logf, 'w') as f:
+            f.writelines(lines)
+        assert bee("{'u/work': 'work'}", self.logf, 'u/work') == 0
+        assert [method for _, method in self.mocks['u'].requests] == \
+            ['put'] * 5 + ['delete'] * 2
+        # after every 2 changes, and once at the end
+        assert writes == [10, 10, 9, 8, 8]
+        assert self.days('u') == self.tally(lines, 'work')
+
+    def test_critkey(self, bee):
+        import beeminder
+        def longer(n):
+            return lambda tags, ts: len(tags) > n
+        def longer_default(n):
+            return lambda tags, ts, n=n: len(tags) > n
+        for make in [longer, longer_default]:
+            assert beeminder.critkey(make(1)) == beeminder.critkey(make(1))
+            assert beeminder.critkey(make(1)) != beeminder.critkey(make(2))
+        assert beeminder.critkey(longer(re.compile('x'))) is None
+
+
+class TestScheduler:
+    class User:
+        def __init__(self, name, seed, gap):
+            self.user = name
+            self.seed = seed
+            self.gap = gap
+            self.rand = rand.ExpRand(seed=seed, gap=gap)
+
+    def test_shared_schedules(self):
+        users = [self.User('alice', 666, 2700), self.User('bob', 666, 2700),
+                 self.User('carol', 42, 3600)]
+        pinger = scheduler.Scheduler()
+        after = rand.BIRTH + 86400
+        for user in users:
+            pinger.add(user, after)
+        assert len(pinger.schedules) == 2
+        assert users[0].rand is users[1].rand
+
+        expected = []
+        for user in [users[0], users[2]]:
+            cursor = user.rand.iter_pings(after=after)
+            for i in range(30):
+                expected.append((next(cursor)[0], user.seed))
+        expected.sort()
+        got = []
+        for i in range(40):
+            ping, pinged = pinger.pop()
+            got.append((ping, pinged[0].seed))
+            assert [user.seed for user in pinged] == \
+                [user.seed for user in users if user.seed == pinged[0].seed]
+        assert got == expected[:40]
+
+
+class TestTimer:
+    def test_wait(self):
+        waker = timer.timer()
+        start = time.time()
+        assert waker.wait(start + 0.05) == []
+        assert time.time() >= start + 0.05
+        assert waker.wait(start - 10) == []  # already past
+
+        r, w = os.pipe()
+        os.write(w, b'x')
+        assert waker.wait(time.time() + 10, [r]) == [r]
+        os.close(r)
+        os.close(w)
+
+
+class TestWatch:
+    def test_changed(self, tmp_path):
+        rc = tmp_path / '.pytagtimerc'
+        rc.write_text('gap = 45*60\n')
+        for make in [watch.watcher, watch.StatWatcher]:
+            w = make(str(rc))
+            assert not w.changed()
+            (tmp_path / 'other').write_text('x')
+            assert not w.changed()
+            tmp = tmp_path / 'rc.tmp'
+            tmp.write_text('gap = 60*60\n')
+            os.replace(str(tmp), str(rc))  # how editors often save
+            assert w.changed()
+            assert not w.changed()
@@ -0,0 +1,111 @@
+'''
+Sleeping until a given unixtime, for the daemon.
+
+On Linux this arms a timerfd with an absolute CLOCK_REALTIME deadline, so
+there are no wakeups at all until the deadline: if the machine is suspended
+across it the timer goes off right after resume, and if the system clock is
+set (eg, by NTP or by hand) the wait ends early so the caller can look at
+the clock again.  Elsewhere we fall back to waking up every couple of
+seconds (or the pause library, if it's installed).
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import time
+try:
+    import pause
+except ImportError:
+    pause = None
+
+CLOCK_REALTIME = 0
+TFD_CLOEXEC = 0o2000000
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+class itimerspec(ctypes.Structure):
+    _fields_ = [('it_interval', timespec), ('it_value', timespec)]
+
+
+class TimerFD:
+    '''Waits on a timerfd, using os.timerfd_* (Python 3.13+) or libc.'''
+
+    def __init__(self):
+        if hasattr(os, 'timerfd_create'):
+            self._libc = None
+            self.fd = os.timerfd_create(time.CLOCK_REALTIME,
+                                        flags=os.TFD_CLOEXEC)
+            return
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.timerfd_create(CLOCK_REALTIME, TFD_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def arm(self, t):
+        '''Makes the timer go off at unixtime t (or when the clock is set).'''
+        flags = TFD_TIMER_ABSTIME | TFD_TIMER_CANCEL_ON_SET
+        t = max(t, 1)  # a zero deadline would disarm the timer
+        if self._libc is None:
+            os.timerfd_settime(self.fd, flags=flags, initial=t)
+            return
+        spec = itimerspec()
+        spec.it_value.tv_sec = int(t)
+        spec.it_value.tv_nsec = int((t - int(t)) * 1e9)
+        if self._libc.timerfd_settime(self.fd, flags, ctypes.byref(spec),
+                                      None) < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def wait(self, t, fds=()):
+        '''Sleeps until unixtime t, or until the clock is set, or until one
+        of the file descriptors in fds is readable.  Returns the list of
+        readable fds (empty if we woke up because of the time).'''
+        self.arm(t)
+        while True:
+            try:
+                ready, _, _ = select.select([self.fd] + list(fds), [], [])
+                break
+            except InterruptedError:
+                pass
+        if self.fd in ready:
+            try:
+                os.read(self.fd, 8)
+            except OSError as e:
+                if e.errno != errno.ECANCELED:  # ie, the clock was set
+                    raise
+        return [fd for fd in ready if fd != self.fd]
+
+
+class PollTimer:
+    '''Waits by checking the time again every few seconds, in case the
+    machine is suspended.'''
+
+    POLL = 2  # seconds
+
+    def wait(self, t, fds=()):
+        if pause and not fds:
+            pause.until(t)
+            return []
+        timeout = min(max(t - time.time(), 0), self.POLL)
+        if fds:
+            ready, _, _ = select.select(list(fds), [], [], timeout)
+            return ready
+        time.sleep(timeout)
+        return []
+
+
+def timer():
+    '''Returns the best timer available on this system.'''
+    try:
+        return TimerFD()
+    except (AttributeError, OSError, TypeError):
+        return PollTimer()
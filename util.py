@@ -9,87 +9,25 @@ import sys
 import time
 
 from settings import settings
+from logparse import strip, stripb, stripc
 
 linelen = settings.linelen
 
 def clip(x, a, b):
     return max(a, min(b, x))
 
-def callcmd(cmd):
-    if subprocess.call(cmd) != 0:
+def callcmd(cmd, env=None):
+    if subprocess.call(cmd, env=env) != 0:
         print('SYSERR:', ' '.join(cmd), file=sys.stderr)
         return False
     return True
 
-def strip(s):
-    '''Strips out stuff in parens and brackets;
-    remaining parens/brackets means they were unmatched.
-
-    '''
-    while True:
-        s, n = re.subn(r'\([^\(\)]*\)', '', s)
-        if n == 0:
-            break
-    while True:
-        s, n = re.subn(r'\[[^\[\]]*\]', '', s)
-        if n == 0:
-            break
-    # Also remove trailing whitespace? (this breaks cntpings)
-    # s = re.sub(r'\s*$', '', s)
-
-    return s
-
-def stripb(s):
-    '''Strips out stuff in brackets only; remaining brackets means
-    they were unmatched.'''
-    return re.sub(r'\s*\[[^\[\]]*\]', '', s)
-
-
-def stripc(s):
-    '''Strips out stuff *not* in parens and brackets.'''
-    pairs = {
-        '(': ')',
-        '[': ']'
-    }
-    reverse_pairs = {val: key for (key, val) in pairs.items()}
-
-    result = []
-    openers = []
-    i = 0
-    while i < len(s):
-        if s[i] in pairs:
-            openers.append(i)
-        elif s[i] in reverse_pairs:
-            if openers and s[openers[-1]] == reverse_pairs[s[i]]:
-                start = openers.pop()
-                if not openers:  # closed all parens
-                    result.append(s[start:i+1])
-                # else ignore/continue, will be appended to the
-                # result when the last parens is closed
-            # else unmatched closer, ignore
-        i += 1
-    return(''.join(result))
-
-# Here is the original perl implementation
-# sub stripc {
-#   my($s) = @_;
-#   my $tmp = $s;
-#   while($tmp =~ s/\([^\(\)]*\)/UNIQUE78DIV/g) {}
-#   while($tmp =~ s/\[[^\[\]]*\]/UNIQUE78DIV/g) {}
-#   my @a = split('UNIQUE78DIV', $tmp);
-#   for(@a) {
-#     my $i = index($s, $_);
-#     substr($s, $i, length($_)) = "";
-#   }
-#   return $s;
-# }
-
 def parsable(s):
     '''Whether the given string is valid line in a tagtime log file'''
-    s = self.strip(s)
+    s = strip(s)
     # return not (not re.search(r'^\d+\s+', s) or
     #             re.search(r'(\(|\)|\[|\])', s))
-    return re.search(r'^\d+\s+', s) and not re.search(r'(\(|\)|\[|\])', s)
+    return bool(re.search(r'^\d+\s+', s)) and not re.search(r'(\(|\)|\[|\])', s)
 
 def fetchp(s):
     '''Fetches stuff in parens. Not currently used.'''
@@ -185,31 +123,42 @@ def lrjust(a, b, x=linelen):
     return '{a}{spaces}{b}'.format(
         a=a, spaces=' ' * max(0, x - len(a) - len(b)), b=b)
 
+# Timestamp formats for annotime, longest first.
+ANNOTIME_FORMATS = [
+    "[%Y-%m-%d %H:%M:%S %a]", # 24 chars
+    "[%m.%d %H:%M:%S %a]",    # 18 chars
+    "[%d %H:%M:%S %a]",       # 15 chars
+    "[%m.%d %H:%M:%S]",       # 14 chars
+    "[%H:%M:%S %a]",          # 12 chars
+    "[%m.%d %H:%M]",          # 11 chars
+    "[%d %H:%M:%S]",          # also 11 so this will never get chosen
+    "[%H:%M %a]",             #  9 chars
+    "[%H:%M:%S]",             #  8 chars
+    "[%d %H:%M]",             # also 8 so this will never get chosen
+    "[%H:%M]",                #  5 chars
+    "[%M]"                    #  2 chars
+]
+
+# Which format annotime picked for a given line length, line width and day
+# of the week.  All the fields are fixed width except the weekday name,
+# so the choice only depends on those.
+_annotime_formats = {}
+
 def annotime(a, t, ll=linelen):
     '''Annotates a line of text with the given timestamp.'''
     tt = datetime.datetime.fromtimestamp(t).timetuple()
-    candidates = [
-        "[%Y-%m-%d %H:%M:%S %a]", # 24 chars
-        "[%m.%d %H:%M:%S %a]",    # 18 chars
-        "[%d %H:%M:%S %a]",       # 15 chars
-        "[%m.%d %H:%M:%S]",       # 14 chars
-        "[%H:%M:%S %a]",          # 12 chars
-        "[%m.%d %H:%M]",          # 11 chars
-        "[%d %H:%M:%S]",          # also 11 so this will never get chosen
-        "[%H:%M %a]",             #  9 chars
-        "[%H:%M:%S]",             #  8 chars
-        "[%d %H:%M]",             # also 8 so this will never get chosen
-        "[%H:%M]",                #  5 chars
-        "[%M]"                    #  2 chars
-    ]
-
-    maxlen = linelen - len(a) - 1
-
-    for candidate_format in candidates:
-        candidate = time.strftime(candidate_format, tt)
-        if len(candidate) + len(a) + 1 <= ll:
-            return lrjust(a, candidate, ll)
-    return a
+    key = (len(a), ll, tt.tm_wday)
+    if key not in _annotime_formats:
+        _annotime_formats[key] = None
+        for candidate_format in ANNOTIME_FORMATS:
+            candidate = time.strftime(candidate_format, tt)
+            if len(candidate) + len(a) + 1 <= ll:
+                _annotime_formats[key] = candidate_format
+                break
+    candidate_format = _annotime_formats[key]
+    if candidate_format is None:
+        return a
+    return lrjust(a, time.strftime(candidate_format, tt), ll)
 
 
 def dd(n):
@@ -342,7 +291,7 @@ def pd(s):
     return time.mktime(tm)
 
 
-def playsound():
+def playsound(settings=settings):
     if not settings.quiet and settings.playsound:
         callcmd(settings.playsound)
 
@@ -0,0 +1,90 @@
+'''
+Noticing when a file (like ~/.pytagtimerc) changes, for the daemon.
+
+On Linux this uses inotify on the file's directory (editors often save by
+writing a new file and renaming it over the old one), so the daemon can
+select() on it along with its timer and react right away.  Elsewhere we
+compare the file's mtime and size whenever we're asked.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (then the name)
+
+
+class InotifyWatcher:
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        directory = os.path.dirname(os.path.abspath(path))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                  IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e))
+
+    def fds(self):
+        '''File descriptors that become readable when the file changes.'''
+        return [self.fd]
+
+    def changed(self):
+        '''Whether the file changed since we last asked.  Doesn't block.'''
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return changed
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, i)
+                i += EVENT.size
+                if data[i:i + length].rstrip(b'\0') == self.name:
+                    changed = True
+                i += length
+
+
+class StatWatcher:
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def fds(self):
+        return []
+
+    def changed(self):
+        '''Whether the file changed since we last asked.'''
+        stamp = self._stamp()
+        changed, self.stamp = stamp != self.stamp, stamp
+        return changed
+
+
+def watcher(path):
+    '''Returns the best available watcher for the given file.'''
+    try:
+        return InotifyWatcher(path)
+    except (AttributeError, OSError):
+        return StatWatcher(path)